@@ -0,0 +1,313 @@
+import asyncio
+import json
+import time
+import aiohttp
+from email_helper import send_email
+from metrics import metrics
+from token_cache import TokenCache
+from seller_cloud_api import MAX_PAGE_NUMBER, chunk_ids, is_last_page, merge_pages
+import transport
+from rate_limiter import (
+    RateLimiter,
+    RetryPolicy,
+    parse_retry_after,
+    RETRY_STATUSES,
+    THROTTLE_STATUSES,
+)
+from urllib.parse import quote, urlsplit
+from config import (
+    sellercloud_credentials,
+    sellercloud_endpoints,
+    SELLERCLOUD_MAX_IN_FLIGHT,
+    SELLERCLOUD_LOOKUP_PAGE_SIZE,
+)
+
+
+class AsyncResponse:
+    """Response returned by AsyncSellerCloudAPI.
+    The body is read before the connection is released, so it can be used like a requests response.
+    """
+
+    def __init__(self, status_code, text, headers):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncSellerCloudAPI:
+    """
+    Asyncio counterpart of SellerCloudAPI, it uses the same endpoints from config.py and the same execute(data, action) contract.
+    The requests are awaited instead of blocking, so one event loop can keep up to max_in_flight of them going at the same time.
+    The access token is shared with SellerCloudAPI through the TokenCache.
+    It has to be used as an async context manager so the session is opened:
+    async with AsyncSellerCloudAPI() as sc_api:
+        response = await sc_api.execute(order_obj, "CREATE_ORDER")
+    """
+
+    def __init__(self, max_in_flight=SELLERCLOUD_MAX_IN_FLIGHT):
+        # The recording and replaying transports wrap requests sessions, aiohttp does not go through them
+        if transport.settings["mode"]:
+            raise ValueError(
+                'The record and replay transports need UPLOAD_MODE = "threads"'
+            )
+
+        self.data = sellercloud_credentials
+        self.endpoints = sellercloud_endpoints
+        self.max_in_flight = max_in_flight
+        self.rate_limiter = RateLimiter()
+        self.retry_policy = RetryPolicy()
+        self.session = None
+        self.semaphore = None
+        self.token_cache = TokenCache(self.data["Username"])
+        self.token = None
+        self.token_expires_at = 0
+        self.token_lock = None
+        self.headers = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def start(self):
+        """Opens the session."""
+        self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        # Only one task gets the token, the others wait for it
+        self.token_lock = asyncio.Lock()
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_in_flight),
+            headers={
+                "Accept": "application/json",
+                "Accept-Encoding": "gzip, deflate",
+            },
+            timeout=aiohttp.ClientTimeout(total=1000),
+        )
+
+    async def _current_headers(self):
+        """Async counterpart of SellerCloudAPI._current_headers."""
+        headers = self.headers
+        if headers is not None and self.token_cache.is_fresh(self.token_expires_at):
+            return headers
+
+        async with self.token_lock:
+            if self.headers is None or not self.token_cache.is_fresh(
+                self.token_expires_at
+            ):
+                cached = self.token_cache.load()
+                if cached:
+                    self._set_token(*cached)
+                else:
+                    await self._fetch_token()
+
+            return self.headers
+
+    async def _replace_token(self, rejected_headers):
+        """Async counterpart of SellerCloudAPI._replace_token."""
+        async with self.token_lock:
+            if self.headers is rejected_headers:
+                cached = self.token_cache.load(rejected=self.token)
+                if cached:
+                    self._set_token(*cached)
+                else:
+                    await self._fetch_token()
+
+            return self.headers
+
+    async def _fetch_token(self):
+        response = await self.execute(self.data, "GET_TOKEN")
+
+        if response is None or response.status_code != 200:
+            raise Exception("Could not get an access token from the SellerCloud API")
+
+        token, expires_at = self.token_cache.parse(response.json())
+        self.token_cache.save(token, expires_at)
+        self._set_token(token, expires_at)
+
+    def _set_token(self, token, expires_at):
+        self.token = token
+        self.token_expires_at = expires_at
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    async def close(self):
+        """Closes the session and its connections."""
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def execute(self, data, action):
+        """Executes a request to the SellerCloud API.
+        It takes the same data and actions as SellerCloudAPI.execute, but has to be awaited.
+        """
+        config = self.endpoints.get(action)
+        if not config:
+            raise ValueError("Invalid API action")
+
+        if action == "GET_TOKEN":
+            return await self.perform_request(self.data, **config)
+
+        # The data is copied because perform_request takes the url_args out of it, and it may be sent twice
+        headers = await self._current_headers()
+        response = await self.perform_request(dict(data), **config, headers=headers)
+
+        # The token expired or was revoked, the request is sent once more with a new one
+        if response is not None and response.status_code == 401:
+            print("SellerCloud rejected the access token, getting a new one.")
+            headers = await self._replace_token(headers)
+            response = await self.perform_request(dict(data), **config, headers=headers)
+
+        return response
+
+    async def get_all_pages(
+        self, url_args, action, page_size=SELLERCLOUD_LOOKUP_PAGE_SIZE
+    ):
+        """Async counterpart of SellerCloudAPI.get_all_pages."""
+        items = []
+        page_number = 1
+
+        while True:
+            response = await self.execute(
+                {
+                    "url_args": {
+                        **url_args,
+                        "page_size": page_size,
+                        "page_number": page_number,
+                    }
+                },
+                action,
+            )
+
+            if response is None or response.status_code != 200:
+                return items, response.text if response is not None else "No response"
+
+            body = response.json()
+            items.extend(body.get("Items", []))
+
+            if is_last_page(body, len(items), page_size):
+                return items, None
+
+            # A server that ignores the page number would send the same page forever
+            if page_number >= MAX_PAGE_NUMBER:
+                return items, f"{action} had more than {MAX_PAGE_NUMBER} pages"
+
+            page_number += 1
+
+    async def bulk_lookup(
+        self, action, ids_arg, ids, page_size=SELLERCLOUD_LOOKUP_PAGE_SIZE
+    ):
+        """Async counterpart of SellerCloudAPI.bulk_lookup, the requests are limited by max_in_flight."""
+        chunks = chunk_ids(self.endpoints[action]["url"], ids_arg, ids, page_size)
+        pages = await asyncio.gather(
+            *(
+                self.get_all_pages({ids_arg: ",".join(chunk)}, action, page_size)
+                for chunk in chunks
+            )
+        )
+        return merge_pages(pages)
+
+    async def perform_request(
+        self,
+        data,
+        type,
+        url,
+        endpoint_error_message,
+        success_message,
+        headers=None,
+    ):
+        """Performs a request to the SellerCloud API.
+        It uses the same rate limiting and retry policy as SellerCloudAPI.perform_request.
+        """
+        error_message = None
+
+        # Every endpoint has its own rate limit, the url template identifies the endpoint
+        bucket = self.rate_limiter.bucket(url)
+        endpoint = f"{type.upper()} {urlsplit(url).path}"
+
+        url_args = data.pop("url_args", None)
+
+        if url_args:
+            formatted_url = self._sanitize_url(url, url_args)
+        else:
+            formatted_url = url
+
+        attempt = 0
+
+        while True:
+            await bucket.acquire_async()
+
+            attempt += 1
+            error_message = None
+            response = None
+            retry_after = None
+            retry = False
+            started = time.perf_counter()
+
+            try:
+                # The semaphore keeps the number of requests in flight under max_in_flight
+                async with self.semaphore:
+                    async with self.session.request(
+                        type.upper(), formatted_url, headers=headers, json=data
+                    ) as raw_response:
+                        text = await raw_response.text()
+                        response = AsyncResponse(
+                            raw_response.status, text, raw_response.headers
+                        )
+            except aiohttp.ClientConnectionError:
+                retry = True
+                error_message = f"Connection error occurred {endpoint_error_message}"
+            except aiohttp.ClientResponseError as http_err:
+                error_message = (
+                    f"HTTP error occurred {endpoint_error_message}{http_err}"
+                )
+            except asyncio.TimeoutError:
+                retry = True
+                error_message = f"Timeout occurred {endpoint_error_message}"
+            except aiohttp.ClientError as err:
+                error_message = f"Other error occurred {endpoint_error_message}{err}"
+            except Exception as e:
+                error_message = (
+                    f"An unexpected error occurred {endpoint_error_message}{e}"
+                )
+            else:
+                if response.status_code in THROTTLE_STATUSES:
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    bucket.throttled(retry_after)
+
+                retry = response.status_code in RETRY_STATUSES
+
+            metrics.record_request(
+                "sellercloud",
+                endpoint,
+                response.status_code if response is not None else "error",
+                time.perf_counter() - started,
+            )
+
+            if not retry or not self.retry_policy.can_retry(attempt):
+                break
+
+            metrics.record_retry("sellercloud", endpoint)
+
+            await asyncio.sleep(self.retry_policy.backoff(attempt, retry_after))
+
+        if error_message:
+            print(error_message)
+            send_email(
+                "There was an error executing a request on SellerCloud API : ",
+                error_message,
+            )
+            return None
+        elif response.status_code != 200:
+            print(f"Error: Received status code {response.status_code}")
+            return response
+        else:
+            print(success_message)
+            return response
+
+    def _sanitize_url(self, url, url_args):
+        """Constructs a URL for a  API request."""
+        sanitized_url_args = {k: quote(str(v)) for k, v in url_args.items()}
+        return url.format(**sanitized_url_args)
@@ -0,0 +1,247 @@
+import asyncio
+import time
+from email_helper import send_email
+from metrics import metrics
+from config import PREFLIGHT_DUPLICATE_CHECK
+from order_results import OrderResult, UPLOADED, DUPLICATE, SKIPPED, FAILED
+
+
+def upload_orders(executor, sc_api, order_objs):
+    """Uploads order objects to SellerCloud using the executor's worker threads.
+    The responses are returned in the same order as the order objects."""
+    return list(
+        executor.map(
+            lambda order_obj: sc_api.execute(order_obj, "CREATE_ORDER"), order_objs
+        )
+    )
+
+
+def build_orders(creator, orders, sellercloud_id, sku_shipping_map):
+    """Creates the SellerCloud order objects for a batch of orders.
+    Returns one result per order, the orders without an order object are marked as skipped.
+    """
+    # Checking the skus of the batch that were not checked by an earlier one
+    creator.load_skus([item.sku for order in orders for item in order.items])
+
+    started = time.perf_counter()
+    results = []
+
+    for order in orders:
+        # Creating the order object to be uploaded to SellerCloud
+        order_obj, shipping_total = creator.create_order(
+            order, sellercloud_id, sku_shipping_map
+        )
+
+        # Keeping the shipping total to write it back to the database
+        order.shipping_total = shipping_total
+
+        # If there are no valid skus, skips the order. Report email was sent in create_order.
+        if not order_obj:
+            results.append(OrderResult(order, status=SKIPPED))
+            continue
+
+        results.append(OrderResult(order, order_obj))
+
+    metrics.add_stage_time("build", time.perf_counter() - started)
+
+    return results
+
+
+def pending_order_objs(results):
+    """Returns the order objects of the results that still have to be uploaded."""
+    return [result.order_obj for result in results if result.status is None]
+
+
+def record_upload_responses(results, responses):
+    """Sets the status of the results that were uploaded from their CREATE_ORDER responses.
+    The responses are in the same order as the results that were pending."""
+    pending = [result for result in results if result.status is None]
+
+    for result, response in zip(pending, responses):
+        # If the order is in SellerCloud, it is ready to be updated in the database once its sellercloud_id is known
+        if (
+            response is not None
+            and response.status_code == 500
+            and "already exists" in response.text
+        ):
+            result.status = DUPLICATE
+            print("Order already in SellerCloud")
+
+        elif response is not None and response.status_code == 200:
+            # Adding the sellercloud_id to the order object
+            result.order.sellercloud_order_id = response.json()
+            result.status = UPLOADED
+            print(f"Order uploaded: {result.order_source_id}")
+
+        else:
+            result.status = FAILED
+            result.error = response.text if response is not None else "No response"
+            send_email(
+                "There was an error uploading an order to SellerCloud",
+                f"Order: {result.order}\n\nError: {result.error}",
+            )
+
+
+def duplicate_results(results):
+    """Returns the results of the orders that were already in SellerCloud and still need their sellercloud_id,
+    by their OrderSourceOrderID."""
+    return {
+        result.order_source_id: result
+        for result in results
+        if result.status == DUPLICATE and result.order.sellercloud_order_id is None
+    }
+
+
+def pending_order_source_ids(results):
+    """Returns the OrderSourceOrderIDs of the results that still have to be uploaded."""
+    return [result.order_source_id for result in results if result.status is None]
+
+
+def lookup_sellercloud_ids(sc_api, order_ids):
+    """Gets the sellercloud_ids of a list of OrderSourceOrderIDs with a bulk lookup that follows every page.
+    Returns the sellercloud_ids found by OrderSourceOrderID and the errors of the lookups that failed.
+    """
+    # NOTE: This is not the sellercloud_order_ids but the OrderSourceOrderIDs
+    items, errors = sc_api.bulk_lookup("GET_SELLERCLOUD_IDS", "order_ids", order_ids)
+    return _sellercloud_ids(items), errors
+
+
+async def lookup_sellercloud_ids_async(sc_api, order_ids):
+    """Async counterpart of lookup_sellercloud_ids, the lookups run concurrently."""
+    items, errors = await sc_api.bulk_lookup(
+        "GET_SELLERCLOUD_IDS", "order_ids", order_ids
+    )
+    return _sellercloud_ids(items), errors
+
+
+def _sellercloud_ids(orders):
+    return {order["OrderSourceOrderID"]: order["ID"] for order in orders}
+
+
+def preflight_duplicates(results, sellercloud_ids):
+    """Marks the pending orders that are already in SellerCloud as duplicates with their sellercloud_id,
+    so they go straight to the write back instead of being posted again."""
+    for result in results:
+        if result.status is None and result.order_source_id in sellercloud_ids:
+            result.order.sellercloud_order_id = sellercloud_ids[result.order_source_id]
+            result.status = DUPLICATE
+            print(f"Order already in SellerCloud: {result.order_source_id}")
+
+
+def add_sellercloud_ids(duplicates, sellercloud_ids, errors):
+    """Adds the sellercloud_ids found in SellerCloud to the duplicate orders.
+    The duplicates that were not found are marked as failed so they are not written back.
+    """
+    if errors:
+        send_email(
+            "There was an error getting the sellercloud_ids from SellerCloud",
+            f"Error: \n{errors}\nOrder IDs: \n{list(duplicates.keys())}",
+        )
+
+    for order_source_id, result in duplicates.items():
+        if order_source_id in sellercloud_ids:
+            # Adding the sellercloud_id to the original order
+            result.order.sellercloud_order_id = sellercloud_ids[order_source_id]
+        else:
+            result.status = FAILED
+            result.error = (
+                errors[0] if errors else "The order was not found in SellerCloud"
+            )
+
+
+def upload_batch(executor, sc_api, results, preflight=None):
+    """Uploads the pending orders of a batch and gets the sellercloud_ids of the ones that were already in SellerCloud.
+    With preflight the batch is looked up in SellerCloud first and only the orders that are not there are posted,
+    it defaults to PREFLIGHT_DUPLICATE_CHECK.
+    """
+    started = time.perf_counter()
+
+    if preflight is None:
+        preflight = PREFLIGHT_DUPLICATE_CHECK
+
+    if preflight:
+        # If the lookup fails the orders are posted and the duplicates are found as usual
+        sellercloud_ids, _ = lookup_sellercloud_ids(
+            sc_api, pending_order_source_ids(results)
+        )
+        preflight_duplicates(results, sellercloud_ids)
+
+    # Adding the orders to SellerCloud, the responses come back in the same order as the batch
+    responses = upload_orders(executor, sc_api, pending_order_objs(results))
+    record_upload_responses(results, responses)
+
+    # Getting the sellercloud_ids for the orders that are in SellerCloud but not in the database
+    duplicates = duplicate_results(results)
+
+    if duplicates:
+        sellercloud_ids, errors = lookup_sellercloud_ids(sc_api, list(duplicates))
+        add_sellercloud_ids(duplicates, sellercloud_ids, errors)
+
+    metrics.add_stage_time("upload", time.perf_counter() - started)
+
+
+async def upload_batch_async(sc_api, results, preflight=None):
+    """Async counterpart of upload_batch."""
+    started = time.perf_counter()
+
+    if preflight is None:
+        preflight = PREFLIGHT_DUPLICATE_CHECK
+
+    if preflight:
+        # If the lookup fails the orders are posted and the duplicates are found as usual
+        sellercloud_ids, _ = await lookup_sellercloud_ids_async(
+            sc_api, pending_order_source_ids(results)
+        )
+        preflight_duplicates(results, sellercloud_ids)
+
+    # Adding the orders to SellerCloud, gather keeps the responses in the same order as the batch
+    responses = await asyncio.gather(
+        *(
+            sc_api.execute(order_obj, "CREATE_ORDER")
+            for order_obj in pending_order_objs(results)
+        )
+    )
+    record_upload_responses(results, responses)
+
+    # Getting the sellercloud_ids for the orders that are in SellerCloud but not in the database
+    duplicates = duplicate_results(results)
+
+    if duplicates:
+        sellercloud_ids, errors = await lookup_sellercloud_ids_async(
+            sc_api, list(duplicates)
+        )
+        add_sellercloud_ids(duplicates, sellercloud_ids, errors)
+
+    metrics.add_stage_time("upload", time.perf_counter() - started)
+
+
+def write_back(ex_db, results):
+    """Updates the database with the orders of the batch that are in SellerCloud."""
+    started = time.perf_counter()
+    orders = [result.order for result in results if result.in_sellercloud]
+
+    if orders:
+        failed = ex_db.updating_order_data_in_db(orders)
+
+        # The orders that could not be updated are retried, they will be found as duplicates in SellerCloud
+        errors = {order.purchase_order_number: error for order, error in failed}
+
+        for result in results:
+            if result.in_sellercloud and result.order.purchase_order_number in errors:
+                result.status = FAILED
+                result.error = errors[result.order.purchase_order_number]
+
+        orders = [result.order for result in results if result.in_sellercloud]
+
+    # The orders that were not uploaded stay in the retry set, since the watermark moves past them
+    ex_db.update_upload_retries(
+        [
+            (result.order.id, result.status)
+            for result in results
+            if not result.in_sellercloud
+        ],
+        [order.id for order in orders],
+    )
+
+    metrics.add_stage_time("write_back", time.perf_counter() - started)
+    metrics.record_orders(results)
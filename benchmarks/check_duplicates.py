@@ -0,0 +1,69 @@
+"""
+Regression check of the duplicate handling: runs main.main() with part of the backlog already in the stub SellerCloud,
+as after a run that crashed before writing its orders back, and checks every order is written back exactly once.
+It runs with the threads and async uploaders, with and without the preflight duplicate check, and streaming.
+
+Usage (from the project root):
+    python -m benchmarks.check_duplicates
+"""
+
+import argparse
+import sys
+
+import batch_steps
+import email_helper
+import main
+from benchmarks.run_benchmark import run
+
+
+def check(orders, existing, mode, preflight, stream):
+    """Runs one backlog and returns the problems found, an empty list if there are none."""
+    main.UPLOAD_MODE = mode
+    # upload_batch reads the setting from its module when it is not passed
+    batch_steps.PREFLIGHT_DUPLICATE_CHECK = preflight
+    args = argparse.Namespace(
+        dropshippers=5,
+        latency=0.0,
+        error_rate=0.0,
+        throttle_rate=0.0,
+        stream=stream,
+        existing=existing,
+    )
+
+    try:
+        result = run(orders, args, [], [])
+    except Exception as e:
+        return [f"the run failed: {e!r}"]
+
+    problems = []
+    if result["written_back"] != orders:
+        problems.append(f"{result['written_back']} of {orders} orders written back")
+    if result["uploaded"] != orders:
+        problems.append(f"{result['uploaded']} of {orders} orders in SellerCloud")
+
+    return problems
+
+
+def main_check():
+    email_helper.dispatcher.send = lambda subject, body: None
+
+    failed = False
+    cases = [
+        ("threads", False, False),
+        ("threads", True, False),
+        ("async", False, False),
+        ("async", True, False),
+        ("threads", False, True),
+    ]
+
+    for mode, preflight, stream in cases:
+        name = f"{'stream' if stream else mode}{' preflight' if preflight else ''}"
+        problems = check(120, 30, mode, preflight, stream)
+        print(f"{name:<20} {'; '.join(problems) or 'ok'}")
+        failed = failed or bool(problems)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main_check()
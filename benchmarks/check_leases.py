@@ -0,0 +1,102 @@
+"""
+Regression check of the sharded mode's leases: a worker holds a dropshipper's lease through a batch that takes longer
+than the lease's ttl, and another worker must not be able to take it meanwhile. A lease that expires because it was
+not renewed must stop its worker's uploads.
+
+Usage (from the project root):
+    python -m benchmarks.check_leases
+"""
+
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from benchmarks.stub_db import StubExampleDb, seed
+from sharding import ShardLease
+
+# Lease ttl of the check, a batch takes SLOW_BATCH seconds
+TTL = 1.0
+SLOW_BATCH = 2.5 * TTL
+
+
+def check_slow_batch(completed_since):
+    """A batch longer than the ttl keeps its lease while the heartbeat renews it."""
+    worker_db, heartbeat_db, other_db = (
+        StubExampleDb(),
+        StubExampleDb(),
+        StubExampleDb(),
+    )
+    problems = []
+
+    lease = ShardLease(worker_db, 1000, "worker-a", completed_since, ttl=TTL)
+    if not lease.acquire():
+        return ["the first worker could not take the lease"]
+
+    lease.start_heartbeat(heartbeat_db)
+
+    try:
+        time.sleep(SLOW_BATCH)
+
+        other = ShardLease(other_db, 1000, "worker-b", completed_since, ttl=TTL)
+        if other.acquire():
+            problems.append("another worker took the lease in the middle of a batch")
+
+        if lease.is_set():
+            problems.append("the worker lost a lease that was being renewed")
+    finally:
+        lease.release()
+        for db in (worker_db, heartbeat_db, other_db):
+            db.close()
+
+    return problems
+
+
+def check_expired(completed_since):
+    """A lease that was not renewed within its ttl stops the worker, another worker may hold it by then."""
+    worker_db = StubExampleDb()
+
+    lease = ShardLease(worker_db, 1001, "worker-a", completed_since, ttl=TTL)
+    if not lease.acquire():
+        return ["the worker could not take the lease"]
+
+    try:
+        time.sleep(TTL * 1.2)
+
+        if not lease.is_set():
+            return ["the worker kept uploading with an expired lease"]
+    finally:
+        lease.release()
+        worker_db.close()
+
+    return []
+
+
+def main_check():
+    failed = False
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        StubExampleDb.path = os.path.join(work_dir, "check.sqlite3")
+        seed(StubExampleDb.path, 1)
+        completed_since = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(
+            hours=1
+        )
+
+        for name, check in (
+            ("slow batch", check_slow_batch),
+            ("expired lease", check_expired),
+        ):
+            try:
+                problems = check(completed_since)
+            except Exception as e:
+                problems = [f"the check failed: {e!r}"]
+
+            print(f"{name:<20} {'; '.join(problems) or 'ok'}")
+            failed = failed or bool(problems)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main_check()
@@ -0,0 +1,117 @@
+"""
+Regression check of incremental loading: runs main.main() with INCREMENTAL_LOADING over a backlog, then inserts
+a purchase order whose date_added is older than the newest one already evaluated, as a late or backdated insert,
+and checks the next run uploads and writes it back.
+
+Usage (from the project root):
+    python -m benchmarks.check_watermark
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import email_helper
+import example_db
+import local_cache
+import main
+import shipping_map
+import token_cache
+from benchmarks.run_benchmark import point_to_stub
+from benchmarks.stub_db import StubExampleDb, seed
+from benchmarks.stub_sellercloud import StubSellerCloud
+
+
+def insert_backdated_order(path, date_added):
+    """Inserts a copy of the first purchase order with a new id and number and the given date_added.
+    Returns its purchase_order_number."""
+    conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+    new_id = conn.execute("SELECT MAX(id) + 1 FROM PurchaseOrders").fetchone()[0]
+    number = f"LATE{new_id:07d}"
+
+    conn.execute(
+        """
+        INSERT INTO PurchaseOrders (
+            id, purchase_order_number, date_added, customer_first_name, customer_last_name,
+            phone, address, city, state, zip, country, dropshipper_id
+        )
+        SELECT ?, ?, ?, customer_first_name, customer_last_name,
+            phone, address, city, state, zip, country, dropshipper_id
+        FROM PurchaseOrders
+        WHERE id = 1
+        """,
+        (new_id, number, date_added),
+    )
+    conn.execute(
+        """
+        INSERT INTO PurchaseOrderItems (purchase_order_id, sku, quantity)
+        SELECT ?, sku, quantity FROM PurchaseOrderItems WHERE purchase_order_id = 1
+        """,
+        (new_id,),
+    )
+    conn.commit()
+    conn.close()
+
+    return number
+
+
+def in_sellercloud(path, number):
+    conn = sqlite3.connect(path)
+    row = conn.execute(
+        "SELECT in_sellercloud FROM PurchaseOrders WHERE purchase_order_number = ?",
+        (number,),
+    ).fetchone()
+    conn.close()
+
+    return bool(row and row[0])
+
+
+def check(orders=100):
+    """Runs the backlog, adds a backdated purchase order and runs again. Returns the problems found."""
+    with tempfile.TemporaryDirectory() as work_dir:
+        db_path = os.path.join(work_dir, "check.sqlite3")
+        skus, customer_ids = seed(db_path, orders, dropshippers=5)
+
+        stub = StubSellerCloud(skus, customer_ids).start()
+        point_to_stub(stub)
+
+        StubExampleDb.path = db_path
+        main.ExampleDb = StubExampleDb
+        local_cache.CACHE_DIR = shipping_map.CACHE_DIR = token_cache.CACHE_DIR = (
+            os.path.join(work_dir, "cache")
+        )
+
+        try:
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                main.main()
+
+                # The seeded orders are one minute apart from 2024-06-01, this one is older than the newest of them
+                number = insert_backdated_order(db_path, datetime(2024, 6, 1, 0, 30))
+                main.main()
+        finally:
+            stub.stop()
+
+        problems = []
+        if not in_sellercloud(db_path, number):
+            problems.append(f"the backdated purchase order {number} was not uploaded")
+
+        return problems
+
+
+def main_check():
+    email_helper.dispatcher.send = lambda subject, body: None
+
+    # ExampleDb reads the setting from its module when it is created
+    example_db.INCREMENTAL_LOADING = True
+
+    problems = check()
+    print(f"{'backdated insert':<20} {'; '.join(problems) or 'ok'}")
+
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main_check()
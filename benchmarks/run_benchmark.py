@@ -0,0 +1,201 @@
+"""
+End to end throughput benchmark of main.main() against local stand-ins for SellerCloud and the database.
+Every backlog size runs against a fresh SQLite database seeded with that many pending purchase orders,
+a stub SellerCloud server and empty local caches. Emails are counted but not sent.
+
+Usage (from the project root):
+    python -m benchmarks.run_benchmark --orders 100 1000 10000 100000 --latency 0.05
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+import config
+import email_helper
+import local_cache
+import main
+import shipping_map
+import token_cache
+from metrics import metrics
+from seller_cloud_api import SellerCloudAPI
+from benchmarks.stub_db import StubExampleDb, order_source_ids, seed
+from benchmarks.stub_sellercloud import StubSellerCloud
+
+ORIGINAL_URLS = {
+    action: endpoint["url"] for action, endpoint in config.sellercloud_endpoints.items()
+}
+
+
+def percentile(values, pct):
+    """Returns the pct percentile of the values using the nearest rank."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def point_to_stub(stub):
+    """Makes every SellerCloud endpoint in config.py use the stub server."""
+    for action, endpoint in config.sellercloud_endpoints.items():
+        endpoint["url"] = ORIGINAL_URLS[action].replace(
+            config.sellercloud_base_url, stub.base_url
+        )
+
+
+def record_upload_latencies(latencies):
+    """Wraps the CREATE_ORDER requests of both SellerCloud clients to record how long each one takes."""
+    execute = SellerCloudAPI.execute
+
+    def timed_execute(self, data, action):
+        start = time.perf_counter()
+        response = execute(self, data, action)
+        if action == "CREATE_ORDER":
+            latencies.append(time.perf_counter() - start)
+        return response
+
+    SellerCloudAPI.execute = timed_execute
+
+    try:
+        from async_seller_cloud_api import AsyncSellerCloudAPI
+    except ImportError:
+        return
+
+    async_execute = AsyncSellerCloudAPI.execute
+
+    async def timed_async_execute(self, data, action):
+        start = time.perf_counter()
+        response = await async_execute(self, data, action)
+        if action == "CREATE_ORDER":
+            latencies.append(time.perf_counter() - start)
+        return response
+
+    AsyncSellerCloudAPI.execute = timed_async_execute
+
+
+def run(orders, args, latencies, emails):
+    """Runs main.main() over a backlog of orders and returns its measurements."""
+    with tempfile.TemporaryDirectory() as work_dir:
+        db_path = os.path.join(work_dir, "bench.sqlite3")
+        skus, customer_ids = seed(db_path, orders, dropshippers=args.dropshippers)
+
+        stub = StubSellerCloud(
+            skus,
+            customer_ids,
+            latency=args.latency,
+            error_rate=args.error_rate,
+            throttle_rate=args.throttle_rate,
+        ).start()
+        point_to_stub(stub)
+
+        # Orders that are already in SellerCloud, as after a run that crashed before writing them back
+        for source_id in order_source_ids(db_path, args.existing):
+            stub.orders[source_id] = len(stub.orders) + 1
+
+        StubExampleDb.path = db_path
+        main.ExampleDb = StubExampleDb
+        local_cache.CACHE_DIR = shipping_map.CACHE_DIR = token_cache.CACHE_DIR = (
+            os.path.join(work_dir, "cache")
+        )
+
+        # Every run is measured on its own and its metrics are kept out of the working directory
+        metrics.reset()
+        metrics.textfile = None
+        metrics.report_file = os.path.join(work_dir, "run_report.json")
+        latencies.clear()
+        emails.clear()
+
+        tracemalloc.start()
+        start = time.perf_counter()
+
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            main.main(stream=args.stream)
+
+        elapsed = time.perf_counter() - start
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stub.stop()
+
+        conn = sqlite3.connect(db_path)
+        written_back = conn.execute(
+            "SELECT COUNT(*) FROM PurchaseOrders WHERE in_sellercloud = 1"
+        ).fetchone()[0]
+        conn.close()
+
+    return {
+        "orders": orders,
+        "mode": "stream" if args.stream else main.UPLOAD_MODE,
+        "seconds": round(elapsed, 3),
+        "orders_per_second": round(written_back / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "peak_memory_mb": round(peak_memory / 1024 / 1024, 1),
+        "uploaded": len(stub.orders),
+        "written_back": written_back,
+        "emails": len(emails),
+    }
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--orders", type=int, nargs="+", default=[100, 1000, 10000, 100000]
+    )
+    parser.add_argument("--dropshippers", type=int, default=20)
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="seconds per stub request"
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--existing",
+        type=int,
+        default=0,
+        help="orders already in the stub SellerCloud before the run, they are uploaded as duplicates",
+    )
+    parser.add_argument("--mode", choices=["threads", "async"], default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--stream", action="store_true", help="run main with the streaming pipeline"
+    )
+    parser.add_argument("--json", help="file where the results are saved")
+    args = parser.parse_args()
+
+    if args.mode:
+        main.UPLOAD_MODE = args.mode
+    if args.workers:
+        main.UPLOAD_WORKERS = args.workers
+
+    # Counting the notifications instead of sending them
+    emails = []
+    email_helper.dispatcher.send = lambda subject, body: emails.append(subject)
+
+    latencies = []
+    record_upload_latencies(latencies)
+
+    results = []
+    header = f"{'orders':>8} {'mode':>8} {'seconds':>9} {'orders/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'peak MB':>8} {'written':>8} {'emails':>7}"
+    print(header)
+
+    for orders in args.orders:
+        result = run(orders, args, latencies, emails)
+        results.append(result)
+        print(
+            f"{result['orders']:>8} {result['mode']:>8} {result['seconds']:>9} {result['orders_per_second']:>9} "
+            f"{result['p50_ms']:>8} {result['p99_ms']:>8} {result['peak_memory_mb']:>8} "
+            f"{result['written_back']:>8} {result['emails']:>7}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main_benchmark()
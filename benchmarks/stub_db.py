@@ -0,0 +1,186 @@
+import random
+import sqlite3
+from datetime import datetime, timedelta
+from example_db import ExampleDb
+
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+sqlite3.register_converter(
+    "TIMESTAMP", lambda value: datetime.fromisoformat(value.decode())
+)
+
+SCHEMA = """
+CREATE TABLE Dropshippers (
+    id INTEGER PRIMARY KEY,
+    code TEXT,
+    sellercloud_customer_id INTEGER,
+    company_shipping_account INTEGER,
+    ship_method TEXT
+);
+CREATE TABLE States (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE Countries (id INTEGER PRIMARY KEY, two_letter_code TEXT);
+CREATE TABLE TaxExempt (dropshipper_id INTEGER, state_id INTEGER, is_exempt INTEGER);
+CREATE TABLE PurchaseOrders (
+    id INTEGER PRIMARY KEY,
+    purchase_order_number TEXT,
+    date_added TIMESTAMP,
+    customer_first_name TEXT,
+    customer_last_name TEXT,
+    phone TEXT,
+    address TEXT,
+    city TEXT,
+    state INTEGER,
+    zip TEXT,
+    country INTEGER,
+    dropshipper_id INTEGER,
+    in_sellercloud INTEGER DEFAULT 0,
+    in_sellercloud_date TIMESTAMP,
+    is_cancelled INTEGER DEFAULT 0,
+    sellercloud_order_id INTEGER,
+    shipping_cost REAL
+);
+CREATE TABLE PurchaseOrderItems (
+    id INTEGER PRIMARY KEY,
+    purchase_order_id INTEGER,
+    sku TEXT,
+    quantity INTEGER
+);
+CREATE TABLE vProductAndAliases (sku TEXT, alias TEXT, shipping_cost REAL);
+CREATE TABLE SellerCloudUploadWatermark (
+    name TEXT PRIMARY KEY,
+    last_purchase_order_id INTEGER,
+    updated_at TIMESTAMP
+);
+CREATE TABLE SellerCloudUploadLeases (
+    sellercloud_customer_id INTEGER PRIMARY KEY,
+    owner TEXT,
+    expires_at TIMESTAMP,
+    released_at TIMESTAMP
+);
+CREATE TABLE SellerCloudUploadRetries (
+    purchase_order_id INTEGER PRIMARY KEY,
+    reason TEXT,
+    attempts INTEGER,
+    last_attempt TIMESTAMP
+);
+CREATE INDEX ix_po_number ON PurchaseOrders (purchase_order_number);
+CREATE INDEX ix_poi_po ON PurchaseOrderItems (purchase_order_id);
+"""
+
+
+def seed(path, orders, dropshippers=20, skus=500, items_per_order=3):
+    """Creates a SQLite database with the ExampleDb tables and orders synthetic pending purchase orders.
+    Returns the skus and the sellercloud customer ids in it."""
+    rng = random.Random(orders)
+    conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+    conn.executescript(SCHEMA)
+
+    sku_numbers = [f"SKU{i:05d}" for i in range(skus)]
+    customer_ids = [1000 + i for i in range(dropshippers)]
+
+    conn.executemany(
+        "INSERT INTO Dropshippers VALUES (?, ?, ?, ?, ?)",
+        [
+            (
+                i + 1,
+                f"D{i:02d}",
+                customer_ids[i],
+                i % 2,
+                "UPS Ground" if i % 3 else "FEDEX Ground HD",
+            )
+            for i in range(dropshippers)
+        ],
+    )
+    conn.execute("INSERT INTO States VALUES (1, 'Florida')")
+    conn.execute("INSERT INTO Countries VALUES (1, 'US')")
+    conn.executemany(
+        "INSERT INTO TaxExempt VALUES (?, 1, 0)",
+        [(i + 1,) for i in range(dropshippers)],
+    )
+    conn.executemany(
+        "INSERT INTO vProductAndAliases VALUES (?, ?, ?)",
+        [(sku, f"{sku}-A", 4.5) for sku in sku_numbers],
+    )
+
+    start = datetime(2024, 6, 1)
+    conn.executemany(
+        """
+        INSERT INTO PurchaseOrders (
+            id, purchase_order_number, date_added, customer_first_name, customer_last_name,
+            phone, address, city, state, zip, country, dropshipper_id
+        ) VALUES (?, ?, ?, 'Jane', 'Doe', '555-0100', '1 Main St', 'Miami', 1, ?, 1, ?)
+        """,
+        (
+            (
+                i + 1,
+                f"PO{i:07d}",
+                start + timedelta(minutes=i),
+                f"{33100 + i % 300}",
+                i % dropshippers + 1,
+            )
+            for i in range(orders)
+        ),
+    )
+    conn.executemany(
+        "INSERT INTO PurchaseOrderItems (purchase_order_id, sku, quantity) VALUES (?, ?, ?)",
+        (
+            (i + 1, rng.choice(sku_numbers), rng.randint(1, 4))
+            for i in range(orders)
+            for _ in range(items_per_order)
+        ),
+    )
+    conn.commit()
+    conn.close()
+
+    return sku_numbers, customer_ids
+
+
+def order_source_ids(path, count):
+    """Returns the OrderSourceOrderIDs create_order gives the first count purchase orders of the database."""
+    conn = sqlite3.connect(path)
+    rows = conn.execute(
+        """
+        SELECT d.code, po.purchase_order_number
+        FROM PurchaseOrders po
+        JOIN Dropshippers d ON d.id = po.dropshipper_id
+        ORDER BY po.id
+        LIMIT ?
+        """,
+        (count,),
+    ).fetchall()
+    conn.close()
+
+    return [
+        number if number.startswith(code) else code + number for code, number in rows
+    ]
+
+
+class StubExampleDb(ExampleDb):
+    """ExampleDb backed by the SQLite database created by seed, instead of Azure SQL."""
+
+    path = None
+
+    def _connect(self):
+        return sqlite3.connect(
+            self.path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False
+        )
+
+    def get_catalog_checksum(self):
+        # SQLite has no CHECKSUM_AGG, the count and totals of the view are close enough for the benchmark
+        self.cursor.execute(
+            """
+            SELECT COUNT(*), TOTAL(LENGTH(sku) + IFNULL(LENGTH(alias), 0)), TOTAL(shipping_cost)
+            FROM vProductAndAliases
+            """
+        )
+        return ":".join(str(value) for value in self.cursor.fetchone())
+
+    def _write_back_chunk(self, purchase_orders_data):
+        # SQLite has no temp tables with fast_executemany, the rows are updated with executemany
+        self.cursor.executemany(
+            """
+            UPDATE PurchaseOrders
+            SET in_sellercloud = 1, in_sellercloud_date = ?, sellercloud_order_id = ?, shipping_cost = ?
+            WHERE purchase_order_number = ?
+            """,
+            purchase_orders_data,
+        )
@@ -0,0 +1,175 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class StubSellerCloud:
+    """
+    Local stand-in for the SellerCloud REST API with the token, Orders, Catalog and Customers endpoints used in config.py.
+    Every request waits latency seconds, and error_rate / throttle_rate of the CREATE_ORDER requests fail with a 500 or a 429.
+    It knows every sku in skus (with the same WholeSalePrice) and every customer in customer_ids.
+    """
+
+    def __init__(
+        self,
+        skus,
+        customer_ids,
+        latency=0.0,
+        error_rate=0.0,
+        throttle_rate=0.0,
+        price=10.0,
+    ):
+        self.skus = set(skus)
+        self.customer_ids = list(customer_ids)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.price = price
+
+        # Orders created in the stub by OrderSourceOrderID
+        self.orders = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_port}/rest/api/"
+
+    def start(self):
+        stub = self
+
+        class Handler(StubHandler):
+            pass
+
+        Handler.stub = stub
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def customer(self, customer_id):
+        return {
+            "ID": customer_id,
+            "General": {
+                "Name": f"Dropshipper {customer_id}",
+                "Email": f"dropshipper{customer_id}@example.com",
+            },
+            "OrderOptions": {"WholesaleDiscount": 5},
+        }
+
+    def create_order(self, order_obj):
+        """Returns the status and body of a CREATE_ORDER request."""
+        roll = random.random()
+        if roll < self.throttle_rate:
+            return 429, "Too many requests"
+        if roll < self.throttle_rate + self.error_rate:
+            return 500, "Injected error"
+
+        source_id = order_obj["OrderDetails"]["OrderSourceOrderID"]
+
+        with self.lock:
+            if source_id in self.orders:
+                return 500, f"Order {source_id} already exists"
+            self.orders[source_id] = len(self.orders) + 1
+            return 200, self.orders[source_id]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    stub = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self._read_body()
+        path = urlparse(self.path).path.lower()
+        time.sleep(self.stub.latency)
+
+        if path.endswith("/token"):
+            return self._send(200, {"access_token": "stub-token"})
+
+        if path.endswith("/orders"):
+            status, payload = self.stub.create_order(body)
+            return self._send(status, payload)
+
+        self._send(404, "Not found")
+
+    def do_GET(self):
+        self._read_body()
+        url = urlparse(self.path)
+        path = url.path.lower()
+        query = parse_qs(url.query)
+        time.sleep(self.stub.latency)
+
+        page_number = int(query.get("model.pageNumber", ["1"])[0])
+        page_size = int(query.get("model.pageSize", ["50"])[0])
+
+        if path.endswith("/catalog"):
+            skus = self._split(query.get("model.sKU", [""])[0])
+            items = [
+                {"ID": sku, "WholeSalePrice": self.stub.price}
+                for sku in skus
+                if sku in self.stub.skus
+            ]
+            return self._send_page(items, page_number, page_size)
+
+        if path.endswith("/orders"):
+            order_ids = self._split(query.get("model.orderSourceOrderIDList", [""])[0])
+            with self.stub.lock:
+                items = [
+                    {"OrderSourceOrderID": order_id, "ID": self.stub.orders[order_id]}
+                    for order_id in order_ids
+                    if order_id in self.stub.orders
+                ]
+            return self._send_page(items, page_number, page_size)
+
+        if path.endswith("/customers"):
+            items = [
+                self.stub.customer(customer_id)
+                for customer_id in self.stub.customer_ids
+            ]
+            return self._send_page(items, page_number, page_size)
+
+        if "/customers/" in path:
+            customer_id = int(path.rsplit("/", 1)[1])
+            return self._send(200, self.stub.customer(customer_id))
+
+        self._send(404, "Not found")
+
+    def do_DELETE(self):
+        self._read_body()
+        time.sleep(self.stub.latency)
+        self._send(200, True)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        return json.loads(raw) if raw else None
+
+    def _split(self, value):
+        return [item.strip() for item in value.split(",") if item.strip()]
+
+    def _send_page(self, items, page_number, page_size):
+        start = (page_number - 1) * page_size
+        self._send(
+            200,
+            {"Items": items[start : start + page_size], "TotalResults": len(items)},
+        )
+
+    def _send(self, status, payload):
+        body = (payload if isinstance(payload, str) else json.dumps(payload)).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.end_headers()
+        self.wfile.write(body)
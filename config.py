@@ -43,13 +43,14 @@ sellercloud_endpoints = {
     "GET_SELLERCLOUD_IDS": {
         "type": "get",
         "url": sellercloud_base_url
-        + "Orders?model.orderSourceOrderIDList={order_ids}&model.pageSize=50",
+        + "Orders?model.orderSourceOrderIDList={order_ids}&model.pageSize={page_size}&model.pageNumber={page_number}",
         "endpoint_error_message": "while getting sellercloud_ids from SellerCloud: ",
         "success_message": "Got sellercloud_ids successfully!",
     },
     "GET_SELLERCLOUD_SKUS": {
         "type": "get",
-        "url": sellercloud_base_url + "Catalog?model.sKU={skus}&model.pageSize=50",
+        "url": sellercloud_base_url
+        + "Catalog?model.sKU={skus}&model.pageSize={page_size}&model.pageNumber={page_number}",
         "endpoint_error_message": "while getting order skus from SellerCloud: ",
         "success_message": "Got all orders skus  from SellerCloud successfully!",
     },
@@ -61,7 +62,8 @@ sellercloud_endpoints = {
     },
     "GET_CUSTOMERS": {
         "type": "get",
-        "url": sellercloud_base_url + "Customers?model.customerType=1",
+        "url": sellercloud_base_url
+        + "Customers?model.customerType=1&model.pageNumber={page_number}&model.pageSize={page_size}",
         "endpoint_error_message": "while getting wholesale customers: ",
         "success_message": "Got customers successfully!",
     },
@@ -78,9 +80,127 @@ zip_tax_api_url = (
     "https://api.zip-tax.com/request/v40?key={api_key}&postalcode={postalcode}"
 )
 
+# Seconds a zip code's tax rate is kept in the cache before it is requested again
+TAX_RATE_CACHE_TTL = 7 * 24 * 60 * 60
+
+# Maximum number of zip codes whose tax rate is kept in memory
+TAX_RATE_CACHE_SIZE = 5000
+
 SENDER_EMAIL = "sender_email@domain.com"
 SENDER_PASSWORD = "sender_password"
 RECIPIENT_EMAILS = [
     "recipient_email_1@domain.com",
     "recipient_email_2@domain.com",
 ]  # List of emails to send the report
+
+# Seconds the email notifications are collected into digests before they are sent, they are also sent at exit
+NOTIFICATION_FLUSH_INTERVAL = 15 * 60
+
+# How orders are uploaded to SellerCloud: "threads" uses a pool of UPLOAD_WORKERS threads, "async" uses one event loop
+UPLOAD_MODE = "threads"
+
+# Look up the orders of each batch in SellerCloud before posting them, so the ones already there are not posted again
+PREFLIGHT_DUPLICATE_CHECK = False
+
+# Number of orders uploaded to SellerCloud at the same time, shared by the dropshippers, which also run this many at a time
+UPLOAD_WORKERS = 8
+
+# Number of purchase orders read from the database at a time when streaming (python main.py --stream)
+STREAM_CHUNK_SIZE = 200
+
+# Number of chunks each stage of the streaming pipeline can have waiting for the next stage
+STREAM_QUEUE_SIZE = 4
+
+# Number of requests the async SellerCloud API client keeps in flight at the same time
+SELLERCLOUD_MAX_IN_FLIGHT = 200
+
+# Requests per second sent to each SellerCloud endpoint. They are not limited until SellerCloud throttles (429/503),
+# then the rate is cut by "decrease" at most once every "cooldown" seconds while it throttles and raised by "increase"
+# requests per second every second, between min_rate and max_rate. Reaching max_rate lifts the limit again
+SELLERCLOUD_RATE_LIMIT = {
+    "min_rate": 1,
+    "max_rate": 200,
+    "burst": 20,
+    "increase": 10,
+    "decrease": 0.8,
+    "cooldown": 2,
+}
+
+# Retries of failed SellerCloud requests, the waits grow from base_delay up to max_delay seconds
+# and budget is the total number of retries allowed per run
+SELLERCLOUD_RETRY = {
+    "max_attempts": 5,
+    "base_delay": 0.5,
+    "max_delay": 60,
+    "budget": 200,
+}
+
+# Seconds between the polls of the daemon mode (--daemon) for new purchase orders
+DAEMON_POLL_INTERVAL = 30
+
+# Seconds the daemon waits without changes in the pending purchase orders before running a cycle anyway, to retry failed orders
+DAEMON_MAX_IDLE = 15 * 60
+
+# Seconds a SellerCloud token is assumed to last when the token response does not say when it expires
+SELLERCLOUD_TOKEN_TTL = 60 * 60
+
+# Seconds before a SellerCloud token expires that a new one is fetched, so no request is sent with an expired token
+SELLERCLOUD_TOKEN_REFRESH_MARGIN = 5 * 60
+
+# Seconds a worker of the sharded mode (--shards) holds the lease of a dropshipper without renewing it,
+# after that another worker can take over the dropshipper's purchase orders
+SHARD_LEASE_TTL = 5 * 60
+
+# Seconds a sharded worker waits before checking again the dropshippers that are leased by other workers
+SHARD_POLL_INTERVAL = 30
+
+# "record" writes the SellerCloud and Zip-Tax requests of a run and their responses to TRANSPORT_CASSETTE,
+# "replay" answers the requests from it without touching the live APIs, None sends the requests as usual
+TRANSPORT_MODE = None
+TRANSPORT_CASSETTE = "cassettes/traffic.jsonl.gz"
+
+# Multiplies the recorded latencies of the replayed responses, 0 answers at once
+TRANSPORT_LATENCY_SCALE = 1.0
+
+# Folder where the data kept between runs is stored
+CACHE_DIR = ".cache"
+
+# Files the metrics of every run are written to, the textfile is meant for node_exporter's textfile collector
+# Setting a path to None skips that file
+METRICS_TEXTFILE = "metrics/sellercloud_upload.prom"
+METRICS_REPORT = "metrics/run_report.json"
+
+# Folder the --profile reports are written to, one subfolder per run
+PROFILE_DIR = "profiles"
+
+# Number of calls of every stage whose allocations are compared with tracemalloc snapshots when profiling
+PROFILE_SNAPSHOTS = 5
+
+# Seconds a wholesale customer is kept in the cache before it is loaded again from SellerCloud
+CUSTOMER_CACHE_TTL = 24 * 60 * 60
+
+# Number of customers requested per GET_CUSTOMERS page
+CUSTOMER_PAGE_SIZE = 50
+
+# Seconds a sku's WholeSalePrice is kept in the catalog cache before it is checked again in SellerCloud
+CATALOG_CACHE_TTL = 6 * 60 * 60
+
+# Number of keep-alive connections the SellerCloud API client keeps open, it should not be less than UPLOAD_WORKERS
+SELLERCLOUD_POOL_SIZE = 16
+
+# Longest url sent to SellerCloud, the ids of a bulk lookup (GET_SELLERCLOUD_IDS, GET_SELLERCLOUD_SKUS) are packed
+# into as few requests as fit under it
+SELLERCLOUD_MAX_URL_LENGTH = 2000
+
+# Number of items per page of the bulk lookups, it can be raised up to the largest page SellerCloud allows
+SELLERCLOUD_LOOKUP_PAGE_SIZE = 50
+
+# Number of requests of one bulk lookup that are sent at the same time
+SELLERCLOUD_LOOKUP_WORKERS = 4
+
+# Load only the purchase orders added after the last run plus the ones that could not be uploaded before,
+# it needs the tables in sql/incremental_loading.sql
+INCREMENTAL_LOADING = False
+
+# Number of purchase orders updated and committed together when they are written back after being uploaded
+WRITE_BACK_CHUNK_SIZE = 1000
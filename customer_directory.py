@@ -0,0 +1,98 @@
+import time
+from local_cache import LocalCache
+from models import Customer
+from metrics import metrics
+from seller_cloud_api import SellerCloudAPI
+from config import CUSTOMER_CACHE_TTL, CUSTOMER_PAGE_SIZE
+
+
+class CustomerDirectory:
+    """
+    Keeps the SellerCloud wholesale customers in a local cache that persists between runs.
+    The cache is filled with paged GET_CUSTOMERS calls, GET_CUSTOMERS_BY_ID is only used for the customers that are still missing.
+    Only complete customer records (the ones with the General and OrderOptions sections OrderCreator uses) are cached.
+    """
+
+    def __init__(
+        self,
+        sc_api: SellerCloudAPI,
+        ttl=CUSTOMER_CACHE_TTL,
+        page_size=CUSTOMER_PAGE_SIZE,
+    ):
+        self.sc_api = sc_api
+        self.cache = LocalCache("customers", ttl)
+        self.page_size = page_size
+        self.refreshed = False
+
+    def get_customers(self, customer_ids):
+        """Returns a dictionary with the customers by id, using the cache when possible.
+        The SellerCloud records are kept in the cache as they are, the Customers only have the fields used to create orders.
+        """
+        started = time.perf_counter()
+        customer_ids = list(customer_ids)
+        customers = self._get_cached(customer_ids)
+
+        # Loading every wholesale customer in bulk the first time a customer is missing
+        if len(customers) < len(customer_ids) and not self.refreshed:
+            self.refresh()
+            customers = self._get_cached(customer_ids)
+
+        # Getting the customers that were not in the bulk load one by one
+        for customer_id in customer_ids:
+            if customer_id not in customers:
+                customers[customer_id] = self._get_customer_by_id(customer_id)
+
+        metrics.add_stage_time("customer_fetch", time.perf_counter() - started)
+
+        return {
+            customer_id: Customer.from_sellercloud(customer)
+            for customer_id, customer in customers.items()
+        }
+
+    def refresh(self):
+        """Loads all the wholesale customers with paged GET_CUSTOMERS calls and stores them in the cache."""
+        self.refreshed = True
+
+        items, error = self.sc_api.get_all_pages({}, "GET_CUSTOMERS", self.page_size)
+
+        # The customers of the pages that were loaded are kept even if a later page failed
+        if error:
+            print("Could not load the wholesale customers in bulk.")
+
+        self.cache.set_many(
+            {
+                customer["ID"]: customer
+                for customer in items
+                if self._is_complete(customer)
+            }
+        )
+
+    def close(self):
+        self.cache.close()
+
+    def _get_cached(self, customer_ids):
+        """Returns the fresh customers in the cache by their original id."""
+        cached = self.cache.get_many(customer_ids)
+        return {
+            customer_id: cached[str(customer_id)]
+            for customer_id in customer_ids
+            if str(customer_id) in cached
+        }
+
+    def _get_customer_by_id(self, customer_id):
+        """Gets a customer from SellerCloud and stores it in the cache."""
+        response = self.sc_api.execute(
+            {"url_args": {"customer_id": customer_id}}, "GET_CUSTOMERS_BY_ID"
+        )
+
+        if response is None or response.status_code != 200:
+            raise Exception(f"Error getting customer {customer_id} from SellerCloud")
+
+        customer = response.json()
+        self.cache.set_many({customer_id: customer})
+
+        return customer
+
+    def _is_complete(self, customer):
+        """Checks if the customer record has the sections needed to create orders."""
+        return "General" in customer and "OrderOptions" in customer
@@ -0,0 +1,86 @@
+import signal
+import threading
+import time
+import traceback
+from email_helper import send_email
+from config import DAEMON_POLL_INTERVAL, DAEMON_MAX_IDLE
+
+
+class UploadDaemon:
+    """
+    Runs the upload cycle over and over in one long lived process, so the connections and caches stay warm between cycles.
+    Every poll_interval seconds it reads a cheap change signal from the database and only runs a cycle when it changed,
+    or when max_idle seconds went by without one, so the orders that failed are retried.
+    The signal is the count and the newest id of the pending purchase orders.
+    SIGTERM and SIGINT stop it gracefully, the cycle that is running stops after its current batch.
+    """
+
+    def __init__(
+        self,
+        change_signal,
+        recover=None,
+        poll_interval=DAEMON_POLL_INTERVAL,
+        max_idle=DAEMON_MAX_IDLE,
+    ):
+        self.change_signal = change_signal
+        # Called after an error, so broken connections are opened again before the next poll
+        self.recover = recover
+        self.poll_interval = poll_interval
+        self.max_idle = max_idle
+        self.stopping = threading.Event()
+
+    def run(self, cycle):
+        """Runs cycle until the daemon is stopped, cycle gets the stopping event to check between batches."""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        last_signal = None
+        last_cycle = 0
+
+        print("Upload daemon started.")
+
+        while not self.stopping.is_set():
+            try:
+                current_signal = self.change_signal()
+
+                if (
+                    current_signal != last_signal
+                    or time.monotonic() - last_cycle >= self.max_idle
+                ):
+                    cycle(self.stopping)
+                    last_cycle = time.monotonic()
+
+                    # The signal is read again so the orders uploaded by this cycle do not trigger the next one
+                    last_signal = self.change_signal()
+
+                    # Purchase orders added while the cycle ran have ids above the newest one it started from,
+                    # the cycle did not load them, so the next poll runs another cycle
+                    if _newest_id(last_signal) > _newest_id(current_signal):
+                        last_signal = None
+
+            except Exception as e:
+                # The daemon keeps going, the next cycle starts over from the database
+                last_signal = None
+                print(f"There was an error in the upload cycle: {e}")
+                send_email(
+                    "An Error Occurred", f"Error: {e}\n\n{traceback.format_exc()}"
+                )
+
+                if self.recover:
+                    try:
+                        self.recover()
+                    except Exception as e:
+                        print(f"Error while recovering from the error: {e}")
+
+            self.stopping.wait(self.poll_interval)
+
+        print("Upload daemon stopped.")
+
+    def stop(self, signum=None, frame=None):
+        """Asks the daemon to stop once the current batch is done."""
+        print("Stopping the upload daemon...")
+        self.stopping.set()
+
+
+def _newest_id(signal):
+    return signal[1] or 0
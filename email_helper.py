@@ -4,13 +4,108 @@ from config import (
     SENDER_EMAIL,
     SENDER_PASSWORD,
     RECIPIENT_EMAILS,
+    NOTIFICATION_FLUSH_INTERVAL,
 )
+import atexit
 import os
 import getpass
+import queue
 import socket
+import threading
+import time
 
 
-def send_email(subject, body):
+class NotificationDispatcher:
+    """
+    Sends the email notifications from a background thread so the caller never waits for SMTP.
+    The messages are grouped by subject into one digest email per subject, the digests are sent every
+    flush_interval seconds and when the program exits, using a single SMTP connection for each flush.
+    """
+
+    def __init__(self, flush_interval=NOTIFICATION_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def send(self, subject, body):
+        """Queues a message to be sent in the next digest."""
+        self._start()
+        self.queue.put((subject, body))
+
+    def close(self):
+        """Sends the pending messages and stops the background thread."""
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+
+        if thread:
+            self.queue.put(None)
+            thread.join()
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name="email-dispatcher", daemon=True
+                )
+                self.thread.start()
+
+    def _run(self):
+        # Bodies of the queued messages by subject, in the order they were received
+        pending = {}
+        next_flush = time.monotonic() + self.flush_interval
+
+        while True:
+            stop = False
+
+            try:
+                message = self.queue.get(timeout=max(0, next_flush - time.monotonic()))
+
+                if message is None:
+                    stop = True
+                else:
+                    subject, body = message
+                    pending.setdefault(subject, []).append(body)
+
+            except queue.Empty:
+                pass
+
+            if stop or time.monotonic() >= next_flush:
+                self._flush(pending)
+                pending = {}
+                next_flush = time.monotonic() + self.flush_interval
+
+            if stop:
+                return
+
+    def _flush(self, pending):
+        """Sends one digest per subject using a single SMTP connection."""
+        if not pending:
+            return
+
+        try:
+            with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
+                server.login(SENDER_EMAIL, SENDER_PASSWORD)
+
+                for subject, bodies in pending.items():
+                    server.send_message(_create_message(subject, _digest(bodies)))
+
+            print(f"{len(pending)} email(s) sent successfully.")
+        except Exception as e:
+            print(f"Error sending email: {e}")
+
+
+def _digest(bodies):
+    """Joins the bodies of the messages with the same subject."""
+    if len(bodies) == 1:
+        return bodies[0]
+
+    separator = "\n\n" + "-" * 40 + "\n\n"
+    return f"{len(bodies)} notifications:\n\n" + separator.join(bodies)
+
+
+def _create_message(subject, body):
     current_dir = os.getcwd()
     folder_name = os.path.basename(current_dir)
     computer_name = socket.gethostname()
@@ -25,10 +120,28 @@ def send_email(subject, body):
     msg["From"] = SENDER_EMAIL
     msg["To"] = ", ".join(RECIPIENT_EMAILS)
 
-    try:
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-            server.login(SENDER_EMAIL, SENDER_PASSWORD)
-            server.send_message(msg)
-        print("Email sent successfully.")
-    except Exception as e:
-        print(f"Error sending email: {e}")
+    return msg
+
+
+# Every module sends its notifications through the same dispatcher, the pending ones are sent at exit
+dispatcher = NotificationDispatcher()
+atexit.register(dispatcher.close)
+
+
+def send_email(subject, body):
+    dispatcher.send(subject, body)
+
+
+def send_missing_parts_error_report(
+    skus, purchase_order_number, dropshipper_name, missing_price
+):
+    """Reports the skus of an order that are not in SellerCloud or have no price."""
+    reason = (
+        "some of its skus have no price in SellerCloud"
+        if missing_price
+        else "some of its skus are not in SellerCloud"
+    )
+    send_email(
+        "Orders With Missing Parts",
+        f"Order {purchase_order_number} from {dropshipper_name} was not uploaded because {reason}:\n{skus}",
+    )
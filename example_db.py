@@ -1,22 +1,94 @@
 from email_helper import send_email
 from collections import defaultdict
-from datetime import datetime
+from itertools import chain
+from datetime import datetime, timedelta, timezone
 import pyodbc
-from config import create_connection_string, db_config
+import time
+from metrics import metrics
+from shipping_map import ShippingMap
+from models import OrderItem, purchase_orders_from_rows
+from config import (
+    create_connection_string,
+    db_config,
+    INCREMENTAL_LOADING,
+    WRITE_BACK_CHUNK_SIZE,
+)
+
+# Columns of the purchase orders that are uploaded to SellerCloud
+PURCHASE_ORDER_COLUMNS = """
+                    d.sellercloud_customer_id,
+                    d.code as dropshipper_code,
+                    po.id,
+                    po.purchase_order_number,
+                    po.date_added,
+                    po.customer_first_name,
+                    po.customer_last_name,
+                    po.phone,
+                    po.address,
+                    po.city,
+                    s.name as state,
+                    po.zip,
+                    c.two_letter_code as country,
+                    po.dropshipper_id,
+                    te.is_exempt,
+                    d.company_shipping_account as ships_with_company_account,
+                    d.ship_method
+"""
+
+# Joins and filters that select the purchase orders that still have to be uploaded to SellerCloud
+PENDING_PURCHASE_ORDERS = """
+                FROM PurchaseOrders po
+                JOIN Dropshippers d ON po.dropshipper_id = d.id
+                JOIN States s ON po.state = s.id
+                JOIN Countries c ON po.country = c.id
+                JOIN TaxExempt te ON po.dropshipper_id = te.dropshipper_id AND po.state = te.state_id
+                WHERE po.in_sellercloud = 0 AND po.is_cancelled = 0 AND d.code != 'ABS' AND po.date_added > '2024-01-01'
+"""
+
+# Filter added to PENDING_PURCHASE_ORDERS when incremental loading is enabled, see sql/incremental_loading.sql
+# The watermark is the id of the newest purchase order evaluated, ids grow in insert order while date_added is the
+# order's date, so a purchase order that is inserted late with an older date is still after the watermark
+INCREMENTAL_FILTER = """
+                AND (
+                    po.id > ?
+                    OR po.id IN (SELECT purchase_order_id FROM SellerCloudUploadRetries)
+                )
+"""
+
+# Service the database calls are recorded as in the metrics, next to the SellerCloud and Zip-Tax requests
+SERVICE = "example_db"
+
+# Name of the watermark row and its value before the first incremental run
+WATERMARK_NAME = "purchase_orders"
+INITIAL_WATERMARK = 0
 
 
 class ExampleDb:
+    # Entry of db_config the connections are opened with, a replayed run points it to a copy of the database
+    config_name = "ExampleDb"
+
     def __init__(self):
         try:
             """Establishes a connection to the Example database"""
 
-            self.conn = pyodbc.connect(create_connection_string(db_config["ExampleDb"]))
+            self.conn = self._connect()
             self.cursor = self.conn.cursor()
 
+            # Only the purchase orders after the watermark and the retry set are loaded when it is enabled
+            self.incremental = INCREMENTAL_LOADING
+            self.high_water_mark = None
+
+            self.write_back_chunk_size = WRITE_BACK_CHUNK_SIZE
+
         except pyodbc.Error as e:
             print(f"Error establishing connection to the ExampleDb database: {e}")
             raise
 
+    def _connect(self):
+        """Opens a new connection to the Example database"""
+        return pyodbc.connect(create_connection_string(db_config[self.config_name]))
+
+    @metrics.call(SERVICE, "update_cancelled_status")
     def update_cancelled_status(self, order):
         """Updates the is_cancelled status of the purchase order"""
 
@@ -27,12 +99,12 @@ class ExampleDb:
                 SET is_cancelled = 1
                 WHERE purchase_order_number = ?
                 """,
-                order["purchase_order_number"],
+                order.purchase_order_number,
             )
 
             self.conn.commit()
             print(
-                f"Order {order['purchase_order_number']} was cancelled in ExampleDb database."
+                f"Order {order.purchase_order_number} was cancelled in ExampleDb database."
             )
 
         except Exception as e:
@@ -42,38 +114,24 @@ class ExampleDb:
                 f"{order}",
             )
 
-    def load_purchase_orders_not_in_sellercloud(self):
-        """Loads the purchase orders that are not in SellerCloud"""
+    @metrics.call(SERVICE, "load_purchase_orders")
+    def load_purchase_orders_not_in_sellercloud(self, sellercloud_customer_ids=None):
+        """Loads the purchase orders that are not in SellerCloud, only the ones of sellercloud_customer_ids if it is given"""
+        started = time.perf_counter()
 
         try:
+            pending_purchase_orders, params = self._pending_purchase_orders(
+                sellercloud_customer_ids
+            )
+
             # Inserting into PurchaseOrders
             self.cursor.execute(
-                """
+                f"""
                 SELECT
-                    d.sellercloud_customer_id,
-                    d.code as dropshipper_code,
-                    po.id,
-                    po.purchase_order_number,
-                    po.date_added,
-                    po.customer_first_name,
-                    po.customer_last_name,
-                    po.phone,
-                    po.address,
-                    po.city,
-                    s.name as state,
-                    po.zip,
-                    c.two_letter_code as country,
-                    po.dropshipper_id,
-                    te.is_exempt,
-                    d.company_shipping_account as ships_with_company_account,
-                    d.ship_method
-                FROM PurchaseOrders po
-                JOIN Dropshippers d ON po.dropshipper_id = d.id
-                JOIN States s ON po.state = s.id
-                JOIN Countries c ON po.country = c.id
-                JOIN TaxExempt te ON po.dropshipper_id = te.dropshipper_id AND po.state = te.state_id
-                WHERE po.in_sellercloud = 0 AND po.is_cancelled = 0 AND d.code != 'ABS' AND po.date_added > '2024-01-01'
-                """
+                    {PURCHASE_ORDER_COLUMNS}
+                {pending_purchase_orders}
+                """,
+                params,
             )
             # Getting the purchase orders data
             rows = self.cursor.fetchall()
@@ -82,41 +140,49 @@ class ExampleDb:
             columns = [col[0] for col in self.cursor.description]
 
             #  Creating object with the purchase orders data
-            po_objects = [dict(zip(columns, row)) for row in rows]
+            po_objects = purchase_orders_from_rows(columns, rows)
+
+            # Remembering the newest purchase order evaluated, the watermark is moved to it once the run is done
+            self._track_high_water_mark(po_objects)
 
             # Sorting the purchase orders by dropshipper_sellercloud_id
             orders_by_dropshipper = {}
             skus_in_batch = []
 
-            for po in po_objects:
-                # Getting the purchase order items
-                self.cursor.execute(
-                    """
-                    SELECT
-                        sku,
-                        quantity
-                    FROM PurchaseOrderItems
-                    WHERE purchase_order_id = ?
-                    """,
-                    po["id"],
+            # Getting the items of all the pending purchase orders in one query
+            self.cursor.execute(
+                f"""
+                SELECT
+                    poi.purchase_order_id,
+                    poi.sku,
+                    poi.quantity
+                FROM PurchaseOrderItems poi
+                WHERE poi.purchase_order_id IN (
+                    SELECT po.id
+                    {pending_purchase_orders}
                 )
-                # Getting the purchase order items data
-                rows = self.cursor.fetchall()
-                # Getting the column names to use as keys
-                columns = [col[0] for col in self.cursor.description]
+                """,
+                params,
+            )
 
+            # Grouping the purchase order items by purchase order
+            items_by_po = defaultdict(list)
+
+            for purchase_order_id, sku, quantity in self.cursor.fetchall():
+                items_by_po[purchase_order_id].append(OrderItem(sku, quantity))
+
+            for po in po_objects:
                 # Creating object with the purchase order items data and a list of skus
-                po_items = []
+                po_items = items_by_po.get(po.id, [])
 
-                for row in rows:
-                    po_items.append(dict(zip(columns, row)))
-                    skus_in_batch.append(row[0])
+                for item in po_items:
+                    skus_in_batch.append(item.sku)
 
                 # Adding the purchase order items to the purchase order object
-                po["items"] = po_items
+                po.items = po_items
 
                 # Get the dropshipper_sellercloud_id from the current object
-                sellercloud_customer_id = po["sellercloud_customer_id"]
+                sellercloud_customer_id = po.sellercloud_customer_id
 
                 # If this sellercloud_customer_id is not in the dictionary, add it with an empty list
                 if not orders_by_dropshipper.get(sellercloud_customer_id):
@@ -125,17 +191,247 @@ class ExampleDb:
                 # Append the current purchase order object to the list of this sellercloud_customer_id
                 orders_by_dropshipper[sellercloud_customer_id].append(po)
 
+            metrics.add_stage_time("load", time.perf_counter() - started)
+
             return orders_by_dropshipper, skus_in_batch
 
         except Exception as e:
             print(f"Error while storing purchase orders: {e}")
             raise
 
+    def iter_purchase_orders_not_in_sellercloud(self, chunk_size):
+        """Streams the purchase orders that are not in SellerCloud, with their items, in lists of up to chunk_size.
+        The purchase orders are read with fetchmany from a cursor on a separate connection, so only one chunk is in memory
+        and this connection stays free for the items queries."""
+
+        pending_purchase_orders, params = self._pending_purchase_orders()
+        stream_conn = self._connect()
+        stream_cursor = stream_conn.cursor()
+
+        try:
+            stream_cursor.execute(
+                f"""
+                SELECT
+                    {PURCHASE_ORDER_COLUMNS}
+                {pending_purchase_orders}
+                ORDER BY po.id
+                """,
+                params,
+            )
+
+            # Getting the column names to use as keys
+            columns = [col[0] for col in stream_cursor.description]
+
+            while True:
+                # Only the time spent reading is counted, not the time the consumer holds the chunk
+                started = time.perf_counter()
+                with metrics.call(SERVICE, "stream_purchase_orders"):
+                    rows = stream_cursor.fetchmany(chunk_size)
+
+                if not rows:
+                    return
+
+                po_objects = purchase_orders_from_rows(columns, rows)
+                self._track_high_water_mark(po_objects)
+
+                items_by_po = self._load_purchase_order_items(
+                    [po.id for po in po_objects]
+                )
+
+                for po in po_objects:
+                    po.items = items_by_po.get(po.id, [])
+
+                metrics.add_stage_time("load", time.perf_counter() - started)
+
+                yield po_objects
+
+        except Exception as e:
+            print(f"Error while streaming purchase orders: {e}")
+            raise
+
+        finally:
+            stream_cursor.close()
+            stream_conn.close()
+
+    def _pending_purchase_orders(self, sellercloud_customer_ids=None):
+        """Returns the FROM and WHERE clauses that select the pending purchase orders and their parameters.
+        With incremental loading only the purchase orders after the watermark and the ones in the retry set are selected.
+        """
+        if sellercloud_customer_ids:
+            placeholders = ", ".join("?" for _ in sellercloud_customer_ids)
+            dropshipper_filter = f"AND d.sellercloud_customer_id IN ({placeholders})\n"
+            dropshipper_params = list(sellercloud_customer_ids)
+        else:
+            dropshipper_filter = ""
+            dropshipper_params = []
+
+        if not self.incremental:
+            return PENDING_PURCHASE_ORDERS + dropshipper_filter, dropshipper_params
+
+        last_purchase_order_id = self.get_watermark()
+
+        # Every load starts from the stored watermark, so it never moves back even if only older orders
+        # from the retry set are loaded, and a long running process does not keep the mark of a failed cycle
+        self.high_water_mark = last_purchase_order_id
+
+        return PENDING_PURCHASE_ORDERS + INCREMENTAL_FILTER + dropshipper_filter, [
+            last_purchase_order_id,
+            *dropshipper_params,
+        ]
+
+    def _track_high_water_mark(self, po_objects):
+        """Keeps the id of the newest purchase order loaded."""
+        for po in po_objects:
+            if self.high_water_mark is None or po.id > self.high_water_mark:
+                self.high_water_mark = po.id
+
+    @metrics.call(SERVICE, "get_watermark")
+    def get_watermark(self):
+        """Gets the id of the last purchase order evaluated by a previous run"""
+        try:
+            self.cursor.execute(
+                """
+                SELECT last_purchase_order_id
+                FROM SellerCloudUploadWatermark
+                WHERE name = ?
+                """,
+                (WATERMARK_NAME,),
+            )
+            row = self.cursor.fetchone()
+
+            # Without a watermark every purchase order since the start date is evaluated
+            if not row:
+                return INITIAL_WATERMARK
+
+            return row[0]
+
+        except Exception as e:
+            print(f"Error while getting the watermark: {e}")
+            raise
+
+    @metrics.call(SERVICE, "save_watermark")
+    def save_watermark(self, high_water_mark):
+        """Moves the watermark to the newest purchase order evaluated by this run"""
+        if not self.incremental or high_water_mark is None:
+            return
+
+        try:
+            self.cursor.execute(
+                """
+                UPDATE SellerCloudUploadWatermark
+                SET last_purchase_order_id = ?, updated_at = ?
+                WHERE name = ?
+                """,
+                (
+                    high_water_mark,
+                    datetime.now(),
+                    WATERMARK_NAME,
+                ),
+            )
+            self.cursor.execute(
+                """
+                INSERT INTO SellerCloudUploadWatermark (name, last_purchase_order_id, updated_at)
+                SELECT ?, ?, ?
+                WHERE NOT EXISTS (SELECT 1 FROM SellerCloudUploadWatermark WHERE name = ?)
+                """,
+                (
+                    WATERMARK_NAME,
+                    high_water_mark,
+                    datetime.now(),
+                    WATERMARK_NAME,
+                ),
+            )
+
+            self.conn.commit()
+
+        except Exception as e:
+            print(f"Error while saving the watermark: {e}")
+            raise
+
+    @metrics.call(SERVICE, "update_upload_retries")
+    def update_upload_retries(self, retries, uploaded_ids):
+        """Adds the purchase orders that could not be uploaded to the retry set, with the reason, and removes the uploaded ones"""
+        if not self.incremental:
+            return
+
+        curr_time = datetime.now()
+
+        try:
+            if retries:
+                self.cursor.executemany(
+                    """
+                    UPDATE SellerCloudUploadRetries
+                    SET attempts = attempts + 1, reason = ?, last_attempt = ?
+                    WHERE purchase_order_id = ?
+                    """,
+                    [
+                        (reason, curr_time, purchase_order_id)
+                        for purchase_order_id, reason in retries
+                    ],
+                )
+                self.cursor.executemany(
+                    """
+                    INSERT INTO SellerCloudUploadRetries (purchase_order_id, reason, attempts, last_attempt)
+                    SELECT ?, ?, 1, ?
+                    WHERE NOT EXISTS (SELECT 1 FROM SellerCloudUploadRetries WHERE purchase_order_id = ?)
+                    """,
+                    [
+                        (purchase_order_id, reason, curr_time, purchase_order_id)
+                        for purchase_order_id, reason in retries
+                    ],
+                )
+
+            # SQL Server accepts up to 2100 parameters per query
+            for i in range(0, len(uploaded_ids), 2000):
+                chunk = uploaded_ids[i : i + 2000]
+                placeholders = ", ".join("?" for _ in chunk)
+                self.cursor.execute(
+                    f"DELETE FROM SellerCloudUploadRetries WHERE purchase_order_id IN ({placeholders})",
+                    chunk,
+                )
+
+            self.conn.commit()
+
+        except Exception as e:
+            print(f"Error while updating the upload retries: {e}")
+            send_email(
+                "There was an error updating the retry set of the following purchase orders: ",
+                f"{retries}",
+            )
+
+    @metrics.call(SERVICE, "load_purchase_order_items")
+    def _load_purchase_order_items(self, purchase_order_ids):
+        """Gets the items of a list of purchase orders grouped by purchase_order_id"""
+        items_by_po = defaultdict(list)
+
+        # SQL Server accepts up to 2100 parameters per query
+        for i in range(0, len(purchase_order_ids), 2000):
+            chunk = purchase_order_ids[i : i + 2000]
+            placeholders = ", ".join("?" for _ in chunk)
+
+            self.cursor.execute(
+                f"""
+                SELECT
+                    purchase_order_id,
+                    sku,
+                    quantity
+                FROM PurchaseOrderItems
+                WHERE purchase_order_id IN ({placeholders})
+                """,
+                chunk,
+            )
+
+            for purchase_order_id, sku, quantity in self.cursor.fetchall():
+                items_by_po[purchase_order_id].append(OrderItem(sku, quantity))
+
+        return items_by_po
+
     def updating_order_data_in_db(self, orders):
-        """Updates the in_sellercloud status of the purchase order"""
+        """Updates the in_sellercloud status of the purchase orders in chunks of WRITE_BACK_CHUNK_SIZE.
+        Returns the orders that could not be updated with their error."""
 
         if not self.conn and self.conn.closed:
-            self.conn = pyodbc.connect(create_connection_string(db_config["ExampleDb"]))
+            self.conn = self._connect()
             self.cursor = self.conn.cursor()
 
         curr_time = datetime.now()
@@ -146,35 +442,132 @@ class ExampleDb:
             purchase_orders_data.append(
                 (
                     curr_time,
-                    order["sellercloud_order_id"],
-                    order["order_amounts"]["shipping_total"],
-                    order["purchase_order_number"],
+                    order.sellercloud_order_id,
+                    order.shipping_total,
+                    order.purchase_order_number,
                 )
             )
 
+        # Orders that could not be updated and the error
+        failed = []
+
+        for i in range(0, len(purchase_orders_data), self.write_back_chunk_size):
+            chunk = purchase_orders_data[i : i + self.write_back_chunk_size]
+            chunk_orders = orders[i : i + self.write_back_chunk_size]
+
+            try:
+                # Execute bulk update for PurchaseOrders, each chunk is committed on its own
+                with metrics.call(SERVICE, "write_back_chunk"):
+                    self._write_back_chunk(chunk)
+                    self.conn.commit()
+
+            except Exception as e:
+                self.conn.rollback()
+                print(f"Error while updating in_sellercloud status: {e}")
+
+                # Updating the chunk row by row to find the orders that fail
+                failed.extend(self._write_back_rows(chunk, chunk_orders))
+
+        if failed:
+            send_email(
+                "There was an error updating the following purchase orders in the database after being added to SellerCloud: ",
+                "\n".join(
+                    f"{order.purchase_order_number}: {error}" for order, error in failed
+                ),
+            )
+
+        return failed
+
+    def _write_back_chunk(self, purchase_orders_data):
+        """Updates a chunk of purchase orders with one set based UPDATE.
+        The rows are sent to a temp table with fast_executemany, so the chunk takes a single round trip.
+        """
+        # The temp table copies the types of the PurchaseOrders columns, and the purchase_order_number gets the
+        # database's collation instead of tempdb's, so the join does not fail with a collation conflict
+        self.cursor.execute(
+            """
+            IF OBJECT_ID('tempdb..#PurchaseOrderWriteBack') IS NULL
+            BEGIN
+                SELECT TOP 0
+                    in_sellercloud_date,
+                    sellercloud_order_id,
+                    shipping_cost,
+                    purchase_order_number COLLATE DATABASE_DEFAULT AS purchase_order_number
+                INTO #PurchaseOrderWriteBack
+                FROM PurchaseOrders
+
+                CREATE CLUSTERED INDEX IX_PurchaseOrderWriteBack
+                ON #PurchaseOrderWriteBack (purchase_order_number)
+            END
+            ELSE
+                TRUNCATE TABLE #PurchaseOrderWriteBack
+            """
+        )
+
+        self.cursor.fast_executemany = True
         try:
-            # Execute bulk update for PurchaseOrders
             self.cursor.executemany(
                 """
-                UPDATE PurchaseOrders
-                SET in_sellercloud = 1, in_sellercloud_date = ?, sellercloud_order_id = ?, shipping_cost = ?
-                WHERE purchase_order_number = ?
+                INSERT INTO #PurchaseOrderWriteBack (in_sellercloud_date, sellercloud_order_id, shipping_cost, purchase_order_number)
+                VALUES (?, ?, ?, ?)
                 """,
                 purchase_orders_data,
             )
+        finally:
+            self.cursor.fast_executemany = False
+
+        self.cursor.execute(
+            """
+            UPDATE po
+            SET in_sellercloud = 1,
+                in_sellercloud_date = wb.in_sellercloud_date,
+                sellercloud_order_id = wb.sellercloud_order_id,
+                shipping_cost = wb.shipping_cost
+            FROM PurchaseOrders po
+            JOIN #PurchaseOrderWriteBack wb ON po.purchase_order_number = wb.purchase_order_number
+            """
+        )
+
+    def _write_back_rows(self, purchase_orders_data, orders):
+        """Updates purchase orders one by one, returning the ones that fail with their error."""
+        failed = []
+
+        for row, order in zip(purchase_orders_data, orders):
+            try:
+                with metrics.call(SERVICE, "write_back_row"):
+                    self.cursor.execute(
+                        """
+                        UPDATE PurchaseOrders
+                        SET in_sellercloud = 1, in_sellercloud_date = ?, sellercloud_order_id = ?, shipping_cost = ?
+                        WHERE purchase_order_number = ?
+                        """,
+                        row,
+                    )
+                    self.conn.commit()
+
+            except Exception as e:
+                self.conn.rollback()
+                failed.append((order, str(e)))
+
+        return failed
+
+    @metrics.call(SERVICE, "load_shipping_map")
+    def get_sku_alias_list(self, current=None):
+        """
+        Gets the shipping cost of the skus and aliases from the database.
+        The current map, or else the map saved in the cache, is reused while the checksum of vProductAndAliases is the same,
+        so the whole view is only read when the catalog changes.
+        """
+        try:
+            checksum = self.get_catalog_checksum()
 
-            self.conn.commit()
+            if current and current.checksum == checksum:
+                return current
 
-        except Exception as e:
-            print(f"Error while updating in_sellercloud status: {e}")
-            send_email(
-                "There was an error updating the following purchase orders in the database after being added to SellerCloud: ",
-                f"{orders}",
-            )
+            shipping_map = ShippingMap.load()
+            if shipping_map and shipping_map.checksum == checksum:
+                return shipping_map
 
-    def get_sku_alias_list(self):
-        """Gets a list of skus and aliases from the database"""
-        try:
             self.cursor.execute(
                 """
                 SELECT
@@ -184,32 +577,34 @@ class ExampleDb:
                 FROM vProductAndAliases
                 """
             )
-            rows = self.cursor.fetchall()
-
-            # Place holder for the sku and alias set
-            sku_alias_map = defaultdict(list)
-
-            # Place holder for the sku and shipping cost set
-            sku_shipping_map = {}
 
-            for sku, alias, shipping_cost in rows:
-                if not alias:
-                    sku_alias_map[sku].append(None)
-                else:
-                    sku_alias_map[sku].append(alias)
+            # Reading the view in chunks so the rows are not all kept in memory at once
+            rows = chain.from_iterable(iter(lambda: self.cursor.fetchmany(10000), []))
+            shipping_map = ShippingMap.from_rows(rows, checksum)
+            shipping_map.save()
 
-                # Storing the shipping cost for each sku and alias
-                if not sku_shipping_map.get(sku):
-                    sku_shipping_map[sku] = shipping_cost
-                if not sku_shipping_map.get(alias):
-                    sku_shipping_map[alias] = shipping_cost
-
-            return sku_shipping_map
+            return shipping_map
 
         except Exception as e:
             print(f"Error while getting skus and aliases: {e}")
             raise
 
+    @metrics.call(SERVICE, "get_catalog_checksum")
+    def get_catalog_checksum(self):
+        """Gets a checksum of vProductAndAliases, it changes whenever a sku, alias or shipping cost changes."""
+        self.cursor.execute(
+            """
+            SELECT
+                COUNT_BIG(*),
+                CHECKSUM_AGG(BINARY_CHECKSUM(sku, alias, shipping_cost))
+            FROM vProductAndAliases
+            """
+        )
+        count, checksum = self.cursor.fetchone()
+
+        return f"{count}:{checksum}"
+
+    @metrics.call(SERVICE, "get_sellercloud_order_ids")
     def get_sellercloud_order_ids(self, purchase_order_numbers=None):
         """Gets the sellercloud order ids for the purchase order numbers"""
         try:
@@ -244,6 +639,141 @@ class ExampleDb:
             print(f"Error while getting sellercloud order ids: {e}")
             raise
 
+    @metrics.call(SERVICE, "get_pending_signal")
+    def get_pending_signal(self):
+        """Returns the count and newest id of the pending purchase orders, it changes when purchase orders are added or uploaded."""
+        self.cursor.execute(
+            f"""
+            SELECT COUNT(*), MAX(po.id)
+            {PENDING_PURCHASE_ORDERS}
+            """
+        )
+        return tuple(self.cursor.fetchone())
+
+    @metrics.call(SERVICE, "get_pending_dropshippers")
+    def get_pending_dropshippers(self, completed_since):
+        """Returns the sellercloud_customer_ids with pending purchase orders, the ones with the most orders first.
+        The dropshippers whose lease was released after completed_since were already done in this run and are left out.
+        """
+        self.cursor.execute(
+            f"""
+            SELECT d.sellercloud_customer_id, COUNT(*) AS pending
+            {PENDING_PURCHASE_ORDERS}
+            AND d.sellercloud_customer_id NOT IN (
+                SELECT sellercloud_customer_id
+                FROM SellerCloudUploadLeases
+                WHERE released_at >= ?
+            )
+            GROUP BY d.sellercloud_customer_id
+            ORDER BY pending DESC
+            """,
+            (completed_since,),
+        )
+        return [row[0] for row in self.cursor.fetchall()]
+
+    @metrics.call(SERVICE, "acquire_lease")
+    def acquire_lease(self, sellercloud_customer_id, owner, ttl, completed_since):
+        """Takes the lease of a dropshipper's purchase orders for ttl seconds if it is free, expired or already ours.
+        Returns True if the lease was taken. The times come from this machine, so the workers' clocks must be in sync.
+        """
+        now = _utc_now()
+        expires_at = now + timedelta(seconds=ttl)
+
+        try:
+            self.cursor.execute(
+                """
+                UPDATE SellerCloudUploadLeases
+                SET owner = ?, expires_at = ?, released_at = NULL
+                WHERE sellercloud_customer_id = ?
+                    AND (owner = ? OR expires_at < ?)
+                    AND (released_at IS NULL OR released_at < ?)
+                """,
+                (
+                    owner,
+                    expires_at,
+                    sellercloud_customer_id,
+                    owner,
+                    now,
+                    completed_since,
+                ),
+            )
+            acquired = self.cursor.rowcount == 1
+
+            if not acquired:
+                self.cursor.execute(
+                    """
+                    INSERT INTO SellerCloudUploadLeases (sellercloud_customer_id, owner, expires_at, released_at)
+                    SELECT ?, ?, ?, NULL
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM SellerCloudUploadLeases WHERE sellercloud_customer_id = ?
+                    )
+                    """,
+                    (
+                        sellercloud_customer_id,
+                        owner,
+                        expires_at,
+                        sellercloud_customer_id,
+                    ),
+                )
+                acquired = self.cursor.rowcount == 1
+
+            self.conn.commit()
+            return acquired
+
+        except pyodbc.IntegrityError:
+            # Another worker inserted the lease first
+            self.conn.rollback()
+            return False
+
+    @metrics.call(SERVICE, "renew_lease")
+    def renew_lease(self, sellercloud_customer_id, owner, ttl):
+        """Extends a lease we hold by ttl seconds, returns False if it expired and another worker took it."""
+        self.cursor.execute(
+            """
+            UPDATE SellerCloudUploadLeases
+            SET expires_at = ?
+            WHERE sellercloud_customer_id = ? AND owner = ?
+            """,
+            (
+                _utc_now() + timedelta(seconds=ttl),
+                sellercloud_customer_id,
+                owner,
+            ),
+        )
+        renewed = self.cursor.rowcount == 1
+        self.conn.commit()
+
+        return renewed
+
+    @metrics.call(SERVICE, "release_lease")
+    def release_lease(self, sellercloud_customer_id, owner):
+        """Gives a lease back once the dropshipper's purchase orders were evaluated."""
+        now = _utc_now()
+        self.cursor.execute(
+            """
+            UPDATE SellerCloudUploadLeases
+            SET expires_at = ?, released_at = ?
+            WHERE sellercloud_customer_id = ? AND owner = ?
+            """,
+            (now, now, sellercloud_customer_id, owner),
+        )
+        self.conn.commit()
+
+    def reconnect(self):
+        """Opens the connection again, used by long running processes after an error."""
+        try:
+            self.close()
+        except pyodbc.Error:
+            pass
+
+        self.conn = self._connect()
+        self.cursor = self.conn.cursor()
+
     def close(self):
         self.cursor.close()
         self.conn.close()
+
+
+def _utc_now():
+    """Current UTC time without a timezone, the way it is stored in DATETIME2 columns."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
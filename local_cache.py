@@ -0,0 +1,78 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from config import CACHE_DIR
+
+
+class LocalCache:
+    """
+    Key/value store kept in a SQLite file inside CACHE_DIR, it is used to keep data from SellerCloud between runs.
+    Every entry saves the time it was stored, entries older than the ttl (in seconds) are considered stale and are not returned.
+    The keys are stored as strings and the values as JSON. It is safe to share between threads.
+    """
+
+    # SQLite limits the number of parameters in a query
+    max_params = 500
+
+    def __init__(self, name, ttl):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            os.path.join(CACHE_DIR, f"{name}.sqlite3"), check_same_thread=False
+        )
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                stored_at REAL NOT NULL
+            )
+            """
+        )
+        self.conn.commit()
+
+    def get_many(self, keys):
+        """Returns a dictionary with the fresh entries for the keys, missing and stale keys are left out."""
+        keys = list({str(key) for key in keys})
+        oldest = time.time() - self.ttl
+        entries = {}
+
+        with self.lock:
+            for i in range(0, len(keys), self.max_params):
+                chunk = keys[i : i + self.max_params]
+                placeholders = ", ".join("?" for _ in chunk)
+                rows = self.conn.execute(
+                    f"""
+                    SELECT key, value
+                    FROM entries
+                    WHERE key IN ({placeholders}) AND stored_at >= ?
+                    """,
+                    (*chunk, oldest),
+                ).fetchall()
+
+                for key, value in rows:
+                    entries[key] = json.loads(value)
+
+        return entries
+
+    def set_many(self, entries):
+        """Stores a dictionary of entries, replacing the ones with the same keys."""
+        stored_at = time.time()
+
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO entries (key, value, stored_at) VALUES (?, ?, ?)",
+                [
+                    (str(key), json.dumps(value), stored_at)
+                    for key, value in entries.items()
+                ],
+            )
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
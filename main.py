@@ -1,153 +1,520 @@
 from email_helper import send_email
-from order_creator import OrderCreator
 from example_db import ExampleDb
-from seller_cloud_api import SellerCloudAPI
+from metrics import metrics
+from batch_steps import build_orders, upload_batch, upload_batch_async, write_back
+from config import (
+    UPLOAD_MODE,
+    UPLOAD_WORKERS,
+    SHARD_POLL_INTERVAL,
+    TRANSPORT_LATENCY_SCALE,
+    db_config,
+)
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import threading
 import traceback
+from datetime import datetime, timezone
 
 
 def batches_creator(objects, batch_size):
-    """Creates batches of objects to be processed."""
-    counter = 1
-    container = []
+    """Creates batches of objects to be processed, keeping the order of the objects."""
     try:
-        # It makes batches of 50 skus to send to SellerCloud
-        while True:
-            if len(objects) > batch_size:
-                batch = [objects.pop() for _ in range(batch_size)]
-            else:
-                batch = objects
-                objects = []
-
-            container.append(batch)
-
-            if not objects:
-                print(f"Done creating batches of {batch_size}.")
-                return container
-
-            counter += 1
+        container = [
+            objects[i : i + batch_size] for i in range(0, len(objects), batch_size)
+        ]
+        print(f"Done creating batches of {batch_size}.")
+        return container
 
     except Exception as e:
         print(f"Error creating batches: {e}")
         raise Exception(f"Error creating batches: {e}")
 
 
-def main():
-    try:
-        ex_db = ExampleDb()
+def upload_dropshippers(
+    ex_db, sc_api, creator, po_objects, sku_shipping_map, executor=None, stop_event=None
+):
+    """Uploads the orders of every dropshipper using a pool of threads and updates the database.
+    The dropshippers run in parallel, each one builds, uploads and writes back its batches in order, and the orders
+    of every batch are posted concurrently by the UPLOAD_WORKERS threads of the executor, shared by all the dropshippers.
+    A given executor, like the profiler's, runs both the dropshippers and the uploads.
+    Returns False if it stopped early because stop_event was set.
+    """
+    # The database connection can only be used by one thread at a time
+    db_lock = threading.Lock()
+
+    # The dropshippers only wait on the uploads, so they have their own threads and can not take all the upload ones
+    upload_executor = executor or ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+    dropshipper_executor = executor or ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+
+    with upload_executor, dropshipper_executor:
+        completed = list(
+            dropshipper_executor.map(
+                lambda dropshipper: upload_dropshipper(
+                    ex_db,
+                    db_lock,
+                    upload_executor,
+                    sc_api,
+                    creator,
+                    *dropshipper,
+                    sku_shipping_map,
+                    stop_event,
+                ),
+                po_objects.items(),
+            )
+        )
+
+    return all(completed)
+
+
+def upload_dropshipper(
+    ex_db,
+    db_lock,
+    executor,
+    sc_api,
+    creator,
+    sellercloud_id,
+    orders,
+    sku_shipping_map,
+    stop_event=None,
+):
+    """Uploads the orders of one dropshipper one batch at a time, the orders within a batch are uploaded concurrently."""
+    # Batch of orders to be uploaded to SellerCloud, this is to avoid uploading too many orders at once
+    for orders in batches_creator(orders, 50):
+        # Stopping between batches, so every uploaded order is written back
+        if stop_event and stop_event.is_set():
+            return False
+
+        results = build_orders(creator, orders, sellercloud_id, sku_shipping_map)
+
+        # The responses are recorded in the order of the batch
+        upload_batch(executor, sc_api, results)
+
+        # Updating the database, one batch at a time in the dropshipper's order
+        with db_lock:
+            write_back(ex_db, results)
+
+    return True
+
+
+async def upload_dropshippers_async(
+    ex_db, creator, po_objects, sku_shipping_map, stop_event=None
+):
+    """Uploads the orders of every dropshipper using one event loop and updates the database.
+    Every dropshipper runs in its own task, so one dropshipper's batch can be built while another one's is uploading.
+    Returns False if it stopped early because stop_event was set.
+    """
+    # Imported here so aiohttp is only needed when UPLOAD_MODE is "async"
+    from async_seller_cloud_api import AsyncSellerCloudAPI
+
+    # The database connection can only be used by one thread at a time
+    db_lock = asyncio.Lock()
+
+    async with AsyncSellerCloudAPI() as sc_api:
+        completed = await asyncio.gather(
+            *(
+                upload_dropshipper_async(
+                    ex_db,
+                    db_lock,
+                    sc_api,
+                    creator,
+                    sellercloud_id,
+                    orders,
+                    sku_shipping_map,
+                    stop_event,
+                )
+                for sellercloud_id, orders in po_objects.items()
+            )
+        )
+
+    return all(completed)
+
+
+async def upload_dropshipper_async(
+    ex_db,
+    db_lock,
+    sc_api,
+    creator,
+    sellercloud_id,
+    orders,
+    sku_shipping_map,
+    stop_event=None,
+):
+    """Uploads the orders of one dropshipper one batch at a time."""
+    for orders in batches_creator(orders, 50):
+        if stop_event and stop_event.is_set():
+            return False
+
+        # The skus are checked in a thread, so the other dropshippers keep uploading meanwhile
+        await asyncio.to_thread(
+            creator.load_skus, [item.sku for order in orders for item in order.items]
+        )
+
+        results = build_orders(creator, orders, sellercloud_id, sku_shipping_map)
+
+        await upload_batch_async(sc_api, results)
+
+        # Updating the database without blocking the event loop
+        async with db_lock:
+            await asyncio.to_thread(write_back, ex_db, results)
+
+    return True
+
+
+def upload_purchase_orders(
+    ex_db,
+    sc_api,
+    creator,
+    customer_directory,
+    po_objects,
+    sku_shipping_map,
+    executor=None,
+    stop_event=None,
+):
+    """Uploads the loaded purchase orders with the UPLOAD_MODE uploader, or with the executor if one is given.
+    Returns False if it stopped early because stop_event was set."""
+    # Getting the dropshippers information from the customers cache or SellerCloud
+    customers = customer_directory.get_customers(po_objects.keys())
+
+    # Every order of the dropshipper shares the same customer
+    for id, orders in po_objects.items():
+        for order in orders:
+            order.customer = customers[id]
+
+    if UPLOAD_MODE == "async" and not executor:
+        return asyncio.run(
+            upload_dropshippers_async(
+                ex_db, creator, po_objects, sku_shipping_map, stop_event
+            )
+        )
+
+    return upload_dropshippers(
+        ex_db, sc_api, creator, po_objects, sku_shipping_map, executor, stop_event
+    )
+
+
+def create_clients():
+    """Creates the SellerCloud client, the order creator and the customer directory.
+    They make no request until an order needs one, and their modules are imported here,
+    so a run without pending orders does not load requests."""
+    from seller_cloud_api import SellerCloudAPI
+    from order_creator import OrderCreator
+    from customer_directory import CustomerDirectory
+
+    sc_api = SellerCloudAPI()
+    return sc_api, OrderCreator(sc_api), CustomerDirectory(sc_api)
 
-        # Getting inventory and sku_alias_set
+
+def load_shipping_map(ex_db, po_objects, current=None):
+    """Returns the shipping map if an order ships with the company account, otherwise current, which may be None.
+    Only those orders use the shipping costs, so the runs without them never read the map.
+    """
+    if not any(
+        order.ships_with_company_account
+        for orders in po_objects.values()
+        for order in orders
+    ):
+        return current
+
+    with metrics.stage("shipping_map"):
+        return ex_db.get_sku_alias_list(current)
+
+
+def run_streaming(ex_db):
+    """Streams the pending orders from the database to SellerCloud without loading the whole backlog first."""
+    from pipeline import StreamingPipeline
+
+    # The orders are not known before they are streamed, so the shipping map is loaded up front
+    with metrics.stage("shipping_map"):
         sku_shipping_map = ex_db.get_sku_alias_list()
 
-        # The skus in batch are all the skus that are in the orders that is being processed
-        # This is used to check if the skus are in SellerCloud using less API calls
-        po_objects, skus_in_batch = ex_db.load_purchase_orders_not_in_sellercloud()
+    # The skus are checked chunk by chunk as the orders are read
+    sc_api, creator, customer_directory = create_clients()
+
+    StreamingPipeline(
+        ex_db, sc_api, creator, customer_directory, sku_shipping_map
+    ).run()
+
+    customer_directory.close()
+    sc_api.close()
+
+
+def run_daemon():
+    """Stays resident and uploads the new purchase orders as they come in.
+    The database connection, the SellerCloud token and session, the checked skus, the customers, the tax rates
+    and the shipping map are kept warm between cycles instead of being loaded again by every run.
+    """
+    # Imported here so the one-shot runs do not install its signal handlers
+    from daemon import UploadDaemon
+
+    ex_db = ExampleDb()
+    sc_api, creator, customer_directory = create_clients()
+    sku_shipping_map = None
+
+    def cycle(stop_event):
+        nonlocal sku_shipping_map
+        metrics.reset()
 
-        sc_api = SellerCloudAPI()
-        creator = OrderCreator(sc_api, skus_in_batch)
+        # The retry budget is per run, every cycle gets the whole budget
+        sc_api.retry_policy.reset()
 
-        # Getting the dropshippers information from SellerCloud
-        for id, orders in po_objects.items():
-            response = sc_api.execute(
-                {"url_args": {"customer_id": id}}, "GET_CUSTOMERS_BY_ID"
+        try:
+            po_objects, _ = ex_db.load_purchase_orders_not_in_sellercloud()
+
+            if not po_objects:
+                return
+
+            # The shipping map is only loaded again when the catalog changed
+            sku_shipping_map = load_shipping_map(ex_db, po_objects, sku_shipping_map)
+
+            # The prices are checked again every cycle, from the catalog cache while it is fresh
+            creator.forget_skus()
+
+            completed = upload_purchase_orders(
+                ex_db,
+                sc_api,
+                creator,
+                customer_directory,
+                po_objects,
+                sku_shipping_map,
+                stop_event=stop_event,
             )
-            customer = response.json()
-            for order in orders:
-                order["customer"] = customer
 
-        # Exiting if there are no orders to upload
-        if not po_objects:
-            print("No orders to upload.")
-            return
+            # A cycle that was stopped early did not evaluate every loaded order, so the watermark stays
+            if completed:
+                ex_db.save_watermark(ex_db.high_water_mark)
+
+        finally:
+            metrics.export()
+
+    try:
+        UploadDaemon(ex_db.get_pending_signal, recover=ex_db.reconnect).run(cycle)
+    finally:
+        customer_directory.close()
+        sc_api.close()
+        ex_db.close()
+
+
+def run_shards(count):
+    """Uploads the pending purchase orders with count worker processes, every dropshipper is a shard leased by one worker.
+    The same command can run on several machines at the same time, the leases are kept in the database.
+    """
+    # Dropshippers whose lease is released after this were done in this run, the workers do not take them again
+    completed_since = datetime.now(timezone.utc).replace(tzinfo=None)
+
+    # Spawned instead of forked so the workers do not inherit the email dispatcher's thread
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=run_shard_worker, args=(index, completed_since))
+        for index in range(count)
+    ]
+
+    for worker in workers:
+        worker.start()
+
+    # Passing SIGTERM on to the workers, they stop after their current batch
+    signal.signal(
+        signal.SIGTERM,
+        lambda signum, frame: [worker.terminate() for worker in workers],
+    )
 
-        for sellercloud_id, orders in po_objects.items():
-            # List of orders that are in SellerCloud and ready to be updated in the database
-            orders_in_sc_not_in_db = {}
+    for worker in workers:
+        worker.join()
 
-            # Batch of orders to be uploaded to SellerCloud, this is to avoid uploading too many orders at once
-            batches = batches_creator(orders, 50)
+    failed = [worker.exitcode for worker in workers if worker.exitcode]
+    if failed:
+        raise Exception(f"{len(failed)} of {count} shard workers failed")
 
-            for orders in batches:
-                for order in orders[:]:
-                    # Since the order is a copy of the original order, we need to get the index of the original order
-                    index = orders.index(order)
 
-                    # Creating the order object to be uploaded to SellerCloud
-                    order_obj, order_amounts = creator.create_order(
-                        order, sellercloud_id, sku_shipping_map
+def run_shard_worker(index, completed_since):
+    """Takes the leases of the dropshippers with pending purchase orders one at a time and uploads their orders,
+    until every dropshipper was done in this run."""
+    from sharding import ShardLease, worker_name
+
+    owner = worker_name(index)
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+
+    # Every worker writes its own metrics files
+    for attribute in ("textfile", "report_file"):
+        path = getattr(metrics, attribute)
+        if path:
+            root, extension = os.path.splitext(path)
+            setattr(metrics, attribute, f"{root}-shard{index}{extension}")
+
+    ex_db = None
+    heartbeat_db = None
+    sc_api = None
+    sku_shipping_map = None
+
+    try:
+        ex_db = ExampleDb()
+
+        # The leases are renewed from a heartbeat thread, which uses its own connection
+        heartbeat_db = ExampleDb()
+
+        # The watermark is shared by all the dropshippers, a worker can not move it for its shards alone
+        ex_db.incremental = False
+
+        while not stop_event.is_set():
+            pending = ex_db.get_pending_dropshippers(completed_since)
+
+            if not pending:
+                break
+
+            acquired = False
+
+            for sellercloud_customer_id in pending:
+                lease = ShardLease(
+                    ex_db,
+                    sellercloud_customer_id,
+                    owner,
+                    completed_since,
+                    stop_event=stop_event,
+                )
+
+                if stop_event.is_set() or not lease.acquire():
+                    continue
+
+                acquired = True
+                lease.start_heartbeat(heartbeat_db)
+
+                try:
+                    po_objects, _ = ex_db.load_purchase_orders_not_in_sellercloud(
+                        [sellercloud_customer_id]
                     )
 
-                    # Adding the order_amounts to the order object
-                    orders[index]["order_amounts"] = order_amounts
-
-                    # If there are no valid skus, skips the order. Report email was sent in create_order.
-                    if not order_obj:
-                        orders.pop(index)
-                        continue
-
-                    # Adding the order to SellerCloud
-                    response = sc_api.execute(order_obj, "CREATE_ORDER")
-
-                    # If the order is in SellerCloud, it is added to the list of orders ready to be updated in the database
-                    if (
-                        response.status_code == 500
-                        and "already exists" in response.text
-                    ):
-                        # Saving a reference of the duplicate order to get the sellercloud_id later
-                        orders_in_sc_not_in_db[
-                            order_obj["OrderDetails"]["OrderSourceOrderID"]
-                        ] = index
-                        print("Order already in SellerCloud")
-
-                    elif response.status_code == 200:
-                        # Adding the sellercloud_id to the order object
-                        orders[index]["sellercloud_order_id"] = response.json()
-                        print(
-                            f"Order uploaded: {order_obj['OrderDetails']['OrderSourceOrderID']}"
+                    if po_objects:
+                        # The SellerCloud client is only created once there is something to upload
+                        if not sc_api:
+                            sc_api, creator, customer_directory = create_clients()
+
+                        # The map is loaded by the first shard that needs it and kept for the rest
+                        if sku_shipping_map is None:
+                            sku_shipping_map = load_shipping_map(ex_db, po_objects)
+
+                        upload_purchase_orders(
+                            ex_db,
+                            sc_api,
+                            creator,
+                            customer_directory,
+                            po_objects,
+                            sku_shipping_map,
+                            stop_event=lease,
                         )
 
-                    else:
-                        unable_to_be_added = orders.pop(index)
-                        send_email(
-                            "There was an error uploading an order to SellerCloud",
-                            f"Order: {unable_to_be_added}\n\nError: {response.text}",
-                        )
+                finally:
+                    lease.release()
 
-                # Getting the sellercloud_ids for the orders that are in SellerCloud but not in the database
-                if orders_in_sc_not_in_db:
+            # The dropshippers left are leased by other workers, checking again later in case one of them crashed
+            if not acquired:
+                stop_event.wait(SHARD_POLL_INTERVAL)
 
-                    # NOTE: This is not the sellercloud_order_ids but the OrderSourceOrderIDs
-                    order_ids = list(orders_in_sc_not_in_db.keys())
+        if sc_api:
+            customer_directory.close()
+            sc_api.close()
+        heartbeat_db.close()
+        ex_db.close()
 
-                    response = sc_api.execute(
-                        {
-                            "url_args": {
-                                "order_ids": " ,".join(order_ids),
-                            }
-                        },
-                        "GET_SELLERCLOUD_IDS",
-                    )
+    except Exception as e:
+        for db in (heartbeat_db, ex_db):
+            if db:
+                db.close()
+        print(f"There was an error in shard worker {owner}: {e}")
+        send_email("An Error Occurred", f"Error: {e}\n\n{traceback.format_exc()}")
+        raise e
 
-                    if response.status_code == 200:
-                        for order in response.json()["Items"]:
+    finally:
+        metrics.export()
 
-                            # Getting the index of the original order
-                            index = orders_in_sc_not_in_db[order["OrderSourceOrderID"]]
 
-                            # Adding the sellercloud_id to the order
-                            orders[index]["sellercloud_order_id"] = order["ID"]
+def profile_stages(profiler):
+    """Wraps the stages of a run and the functions that are usually hot in the profiler."""
+    import requests.models
+    from order_creator import OrderCreator
+    from customer_directory import CustomerDirectory
 
-                    else:
-                        send_email(
-                            "There was an error getting the sellercloud_ids from SellerCloud",
-                            f"Error: \n{response.text}\nOrder IDs: \n{order_ids}",
-                        )
+    this_module = sys.modules[__name__]
+
+    profiler.instrument(ExampleDb, "get_sku_alias_list", "shipping_map")
+    profiler.instrument(ExampleDb, "load_purchase_orders_not_in_sellercloud", "load")
+    profiler.instrument(OrderCreator, "_get_skus_in_sellercloud", "sku_check")
+    profiler.instrument(CustomerDirectory, "get_customers", "customer_fetch")
+    profiler.instrument(this_module, "batches_creator")
+    profiler.instrument(this_module, "build_orders", "build")
+    profiler.instrument(OrderCreator, "create_order")
+    profiler.instrument(OrderCreator, "_validate_skus")
+    profiler.instrument(OrderCreator, "_create_skus")
+    profiler.instrument(this_module, "upload_batch", "upload")
+    profiler.instrument(this_module, "write_back")
+    profiler.instrument(ExampleDb, "updating_order_data_in_db", "write_back_db")
+
+    # The request bodies are encoded by requests, which may use simplejson instead of json
+    profiler.instrument(json, "dumps", "json_encode")
+    if requests.models.complexjson is not json:
+        profiler.instrument(requests.models.complexjson, "dumps", "json_encode")
+
+
+def main(stream=False, profile=False):
+    profiler = None
+
+    if profile:
+        # Imported here so a run that does not profile does not load it
+        from profiling import Profiler
 
-                    orders_in_sc_not_in_db.clear()
+        profiler = Profiler()
+        profile_stages(profiler)
+        profiler.start()
 
-                if orders:
-                    # Updating the database
-                    ex_db.updating_order_data_in_db(orders)
+    try:
+        ex_db = ExampleDb()
+
+        if stream:
+            run_streaming(ex_db)
+            ex_db.close()
+            return
+
+        # The skus are checked batch by batch while the orders are built, so the list of the run's skus is not needed
+        po_objects, _ = ex_db.load_purchase_orders_not_in_sellercloud()
+
+        # Exiting if there are no orders to upload
+        if not po_objects:
+            print("No orders to upload.")
+            ex_db.close()
+            return
+
+        # Getting inventory and sku_alias_set, only if an order ships with the company account
+        sku_shipping_map = load_shipping_map(ex_db, po_objects)
+
+        sc_api, creator, customer_directory = create_clients()
+        executor = None
+
+        if profiler:
+            from profiling import SerialExecutor
+
+            # cProfile only follows one thread, so a profiled run uploads every order from this thread
+            executor = SerialExecutor()
+
+        upload_purchase_orders(
+            ex_db,
+            sc_api,
+            creator,
+            customer_directory,
+            po_objects,
+            sku_shipping_map,
+            executor,
+        )
+        customer_directory.close()
 
+        # Every loaded order was evaluated, so the next run starts after them
+        ex_db.save_watermark(ex_db.high_water_mark)
+
+        sc_api.close()
         ex_db.close()
 
     except Exception as e:
@@ -157,6 +524,113 @@ def main():
         send_email("An Error Occurred", f"Error: {e}\n\n{traceback.format_exc()}")
         raise e
 
+    finally:
+        if profiler:
+            print(f"Profile written to {profiler.stop()}")
+
+        # Writing the metrics of the run, even when it failed
+        metrics.export()
+
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+        description="Uploads the pending purchase orders to SellerCloud."
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="stream the orders from the database in chunks instead of loading the whole backlog first",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="profile every stage with cProfile and tracemalloc and write the reports to PROFILE_DIR",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="stay resident and poll for new purchase orders every DAEMON_POLL_INTERVAL seconds until SIGTERM",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        metavar="WORKERS",
+        help="upload with this many worker processes, each dropshipper is leased by one worker at a time",
+    )
+    parser.add_argument(
+        "--record",
+        metavar="CASSETTE",
+        help="record the SellerCloud and Zip-Tax requests of the run and their responses to this file",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="CASSETTE",
+        help="answer the SellerCloud and Zip-Tax requests from a recorded file instead of the live APIs",
+    )
+    parser.add_argument(
+        "--replay-db",
+        metavar="DB_CONFIG",
+        help="db_config entry of the copy of the database a replayed run loads from and writes back to",
+    )
+    parser.add_argument(
+        "--latency-scale",
+        type=float,
+        default=TRANSPORT_LATENCY_SCALE,
+        help="multiply the recorded latencies of the replayed responses by this, 0 answers at once",
+    )
+    args = parser.parse_args()
+
+    # The streaming stages run in their own threads, which cProfile can not follow
+    if args.profile and args.stream:
+        parser.error("--profile can not be used with --stream")
+
+    if args.daemon and (args.stream or args.profile):
+        parser.error("--daemon can not be used with --stream or --profile")
+
+    if args.shards and (args.stream or args.profile or args.daemon):
+        parser.error("--shards can not be used with --stream, --profile or --daemon")
+
+    if args.record and args.replay:
+        parser.error("--record can not be used with --replay")
+
+    # The worker processes would share one cassette, and the async client does not go through the transport
+    if (args.record or args.replay) and (args.shards or UPLOAD_MODE == "async"):
+        parser.error(
+            '--record and --replay can not be used with --shards or UPLOAD_MODE = "async"'
+        )
+
+    # A replayed run writes the replayed sellercloud_ids back, so it never runs against the live database
+    if args.replay:
+        live_db = db_config[ExampleDb.config_name]
+        replay_db = db_config.get(args.replay_db)
+
+        if not replay_db:
+            parser.error(
+                "--replay needs --replay-db with the db_config entry of a copy of the database"
+            )
+
+        if (replay_db["server"], replay_db["database"]) == (
+            live_db["server"],
+            live_db["database"],
+        ):
+            parser.error("--replay-db has to be a different database than ExampleDb")
+
+        ExampleDb.config_name = args.replay_db
+    elif args.replay_db:
+        parser.error("--replay-db can only be used with --replay")
+
+    if args.record or args.replay:
+        import transport
+
+        transport.configure(
+            "record" if args.record else "replay",
+            args.record or args.replay,
+            args.latency_scale,
+        )
+
+    if args.daemon:
+        run_daemon()
+    elif args.shards:
+        run_shards(args.shards)
+    else:
+        main(stream=args.stream, profile=args.profile)
@@ -0,0 +1,281 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+from config import METRICS_TEXTFILE, METRICS_REPORT
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Prefix of the exported Prometheus metrics
+PREFIX = "sellercloud_upload"
+
+
+class Metrics:
+    """
+    Collects the metrics of one run: request counts by status code, retries and latency histograms per endpoint
+    (and per database call), time spent in every stage and the number of orders by result status.
+    They are exported at the end of the run as a Prometheus textfile and as a JSON report. It is safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        buckets=LATENCY_BUCKETS,
+        textfile=METRICS_TEXTFILE,
+        report_file=METRICS_REPORT,
+    ):
+        self.buckets = buckets
+        self.textfile = textfile
+        self.report_file = report_file
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clears the metrics so a new run starts from zero."""
+        with self.lock:
+            self.started_at = time.time()
+            self.started = time.perf_counter()
+            self.requests = {}
+            self.stages = {}
+            self.orders = {}
+
+    def record_request(self, service, endpoint, status, seconds):
+        """Records one attempt of a request, status is the status code or "error" when there was no response."""
+        with self.lock:
+            request = self.requests.setdefault(
+                (service, endpoint),
+                {
+                    "statuses": {},
+                    "retries": 0,
+                    "buckets": [0] * (len(self.buckets) + 1),
+                    "sum": 0.0,
+                    "count": 0,
+                },
+            )
+            request["statuses"][str(status)] = (
+                request["statuses"].get(str(status), 0) + 1
+            )
+            request["buckets"][bisect_left(self.buckets, seconds)] += 1
+            request["sum"] += seconds
+            request["count"] += 1
+
+    @contextmanager
+    def call(self, service, endpoint):
+        """Times a call that is not an HTTP request, like a database query, and records it as a request attempt
+        with the status "ok", or "error" if it raised. It can also decorate a function.
+        """
+        started = time.perf_counter()
+        status = "error"
+        try:
+            yield
+            status = "ok"
+        finally:
+            self.record_request(
+                service, endpoint, status, time.perf_counter() - started
+            )
+
+    def record_retry(self, service, endpoint):
+        with self.lock:
+            request = self.requests.get((service, endpoint))
+            if request:
+                request["retries"] += 1
+
+    def record_orders(self, results):
+        """Counts the orders of a batch by the status of their result."""
+        with self.lock:
+            for result in results:
+                status = result.status or "pending"
+                self.orders[status] = self.orders.get(status, 0) + 1
+
+    @contextmanager
+    def stage(self, name):
+        """Times a block of a stage, the time of every block of the same stage is added up."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.perf_counter() - started)
+
+    def add_stage_time(self, name, seconds):
+        with self.lock:
+            stage = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+            stage["seconds"] += seconds
+            stage["calls"] += 1
+
+    def report(self):
+        """Returns the metrics of the run as a dictionary."""
+        with self.lock:
+            duration = time.perf_counter() - self.started
+            uploaded = self.orders.get("uploaded", 0)
+
+            return {
+                "started_at": datetime.fromtimestamp(self.started_at).isoformat(),
+                "duration_seconds": round(duration, 3),
+                "orders": dict(self.orders),
+                "orders_per_second": round(uploaded / duration, 3) if duration else 0,
+                "stages": {
+                    name: {
+                        "seconds": round(stage["seconds"], 3),
+                        "calls": stage["calls"],
+                    }
+                    for name, stage in self.stages.items()
+                },
+                "requests": [
+                    {
+                        "service": service,
+                        "endpoint": endpoint,
+                        "count": request["count"],
+                        "statuses": dict(request["statuses"]),
+                        "retries": request["retries"],
+                        "sum_seconds": round(request["sum"], 6),
+                        "mean_ms": round(request["sum"] / request["count"] * 1000, 2),
+                        "buckets": dict(
+                            zip(
+                                [str(bound) for bound in self.buckets] + ["+Inf"],
+                                request["buckets"],
+                            )
+                        ),
+                    }
+                    for (service, endpoint), request in self.requests.items()
+                ],
+            }
+
+    def prometheus(self):
+        """Returns the metrics of the run in the Prometheus text format."""
+        report = self.report()
+        lines = []
+
+        def metric(name, type, help, samples):
+            lines.append(f"# HELP {PREFIX}_{name} {help}")
+            lines.append(f"# TYPE {PREFIX}_{name} {type}")
+            for labels, value in samples:
+                lines.append(f"{PREFIX}_{name}{_labels(labels)} {value}")
+
+        metric(
+            "last_run_timestamp_seconds",
+            "gauge",
+            "Unix time the last run started.",
+            [({}, round(self.started_at, 3))],
+        )
+        metric(
+            "run_duration_seconds",
+            "gauge",
+            "Duration of the last run.",
+            [({}, report["duration_seconds"])],
+        )
+        metric(
+            "orders_per_second",
+            "gauge",
+            "Orders uploaded per second in the last run.",
+            [({}, report["orders_per_second"])],
+        )
+        metric(
+            "orders",
+            "gauge",
+            "Orders of the last run by result status.",
+            [({"status": status}, count) for status, count in report["orders"].items()],
+        )
+        metric(
+            "stage_duration_seconds",
+            "gauge",
+            "Time spent in every stage of the last run.",
+            [({"stage": name}, s["seconds"]) for name, s in report["stages"].items()],
+        )
+        metric(
+            "stage_calls",
+            "gauge",
+            "Number of times every stage ran in the last run.",
+            [({"stage": name}, s["calls"]) for name, s in report["stages"].items()],
+        )
+        metric(
+            "requests",
+            "gauge",
+            "Request attempts and database calls of the last run by endpoint and status code.",
+            [
+                (
+                    {
+                        "service": r["service"],
+                        "endpoint": r["endpoint"],
+                        "status": status,
+                    },
+                    count,
+                )
+                for r in report["requests"]
+                for status, count in r["statuses"].items()
+            ],
+        )
+        metric(
+            "request_retries",
+            "gauge",
+            "Retried requests of the last run by endpoint.",
+            [
+                ({"service": r["service"], "endpoint": r["endpoint"]}, r["retries"])
+                for r in report["requests"]
+            ],
+        )
+
+        # The histogram buckets are cumulative in the Prometheus format
+        samples = []
+        for r in report["requests"]:
+            labels = {"service": r["service"], "endpoint": r["endpoint"]}
+            total = 0
+            for bound, count in r["buckets"].items():
+                total += count
+                samples.append(("_bucket", {**labels, "le": bound}, total))
+            samples.append(("_sum", labels, r["sum_seconds"]))
+            samples.append(("_count", labels, r["count"]))
+
+        name = f"{PREFIX}_request_duration_seconds"
+        lines.append(
+            f"# HELP {name} Latency of the request attempts and database calls of the last run."
+        )
+        lines.append(f"# TYPE {name} histogram")
+        for suffix, labels, value in samples:
+            lines.append(f"{name}{suffix}{_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        """Writes the Prometheus textfile and the JSON report, a None path skips that file."""
+        try:
+            if self.textfile:
+                _write_file(self.textfile, self.prometheus())
+            if self.report_file:
+                _write_file(self.report_file, json.dumps(self.report(), indent=2))
+        except OSError as e:
+            # The metrics should never make a run fail
+            print(f"Error while exporting the metrics: {e}")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+
+    return (
+        "{"
+        + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+        + "}"
+    )
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _write_file(path, content):
+    """Writes the file in one step, so the textfile collector never reads half of it."""
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+    with open(f"{path}.tmp", "w") as file:
+        file.write(content)
+
+    os.replace(f"{path}.tmp", path)
+
+
+# Metrics of the current run, shared by every module
+metrics = Metrics()
@@ -0,0 +1,78 @@
+from dataclasses import dataclass, field, fields
+from datetime import datetime
+
+
+@dataclass(slots=True)
+class OrderItem:
+    """One sku of a purchase order."""
+
+    sku: str
+    quantity: int
+
+
+@dataclass(slots=True)
+class Customer:
+    """
+    Wholesale customer of a dropshipper in SellerCloud, with only the fields used to create orders.
+    One instance is shared by all the orders of the dropshipper instead of copying the SellerCloud record into each one.
+    """
+
+    id: int
+    name: str
+    email: str
+    wholesale_discount: float
+
+    @classmethod
+    def from_sellercloud(cls, customer):
+        """Creates the customer from a SellerCloud customer record."""
+        return cls(
+            id=customer.get("ID"),
+            name=customer["General"]["Name"],
+            email=customer["General"]["Email"],
+            wholesale_discount=customer["OrderOptions"]["WholesaleDiscount"],
+        )
+
+
+@dataclass(slots=True)
+class PurchaseOrder:
+    """
+    Purchase order that has to be uploaded to SellerCloud.
+    The fields up to ship_method are the columns of PURCHASE_ORDER_COLUMNS in example_db.py, in the same order,
+    the rest are filled in while the order is processed.
+    """
+
+    sellercloud_customer_id: int
+    dropshipper_code: str
+    id: int
+    purchase_order_number: str
+    date_added: datetime
+    customer_first_name: str
+    customer_last_name: str
+    phone: str
+    address: str
+    city: str
+    state: str
+    zip: str
+    country: str
+    dropshipper_id: int
+    is_exempt: bool
+    ships_with_company_account: bool
+    ship_method: str
+    items: list = field(default_factory=list)
+    customer: Customer = None
+    sellercloud_order_id: int = None
+    shipping_total: float = None
+
+
+# Names of the PurchaseOrder fields, the columns of a purchase order row must be the first ones
+PURCHASE_ORDER_FIELDS = tuple(f.name for f in fields(PurchaseOrder))
+
+
+def purchase_orders_from_rows(columns, rows):
+    """Creates the purchase orders of database rows, the row values are passed by position so no dict is built per row."""
+    if tuple(columns) != PURCHASE_ORDER_FIELDS[: len(columns)]:
+        raise ValueError(
+            f"The purchase order columns {columns} do not match the PurchaseOrder fields"
+        )
+
+    return [PurchaseOrder(*row) for row in rows]
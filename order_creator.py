@@ -1,67 +1,84 @@
 from seller_cloud_api import SellerCloudAPI
-from config import zip_tax_api_key
+from local_cache import LocalCache
+from metrics import metrics
+from config import zip_tax_api_key, CATALOG_CACHE_TTL
 from sales_tax_api import SalesTaxApi
 from email_helper import send_missing_parts_error_report, send_email
 from decimal_rounding import round_to_decimal
+from decimal import Decimal
 
 
 class OrderCreator:
-    def __init__(self, sc_api: SellerCloudAPI, skus_in_batch):
+    def __init__(self, sc_api: SellerCloudAPI):
         self.sc_api = sc_api
         self.t_api = SalesTaxApi(zip_tax_api_key)
-        self.skus_in_sellercloud = self._get_skus_in_sellercloud(skus_in_batch)
+        self.catalog_cache = LocalCache("catalog", CATALOG_CACHE_TTL)
+
+        # The skus are checked batch by batch with load_skus, so the first batch does not wait for the whole run's skus
+        self.skus_in_sellercloud = {}
+        # The skus SellerCloud did not return, they are not requested again in the same run
+        self.skus_not_in_sellercloud = set()
+
+    def load_skus(self, sku_numbers):
+        """Checks the skus that were not checked yet, so orders with them can be created."""
+        missing = [
+            sku
+            for sku in sku_numbers
+            if sku not in self.skus_in_sellercloud
+            and sku not in self.skus_not_in_sellercloud
+        ]
+
+        if missing:
+            with metrics.stage("sku_check"):
+                self.skus_in_sellercloud.update(self._get_skus_in_sellercloud(missing))
+
+    def forget_skus(self):
+        """Drops the skus checked so far, so the next load_skus gets their prices again from the catalog cache or SellerCloud."""
+        self.skus_in_sellercloud = {}
+        self.skus_not_in_sellercloud = set()
 
     def create_order(self, order, sellercloud_id, sku_shipping_map):
-        """Create order objects for SellerCloud and get the order totals."""
-        dropshipper_name = order["customer"]["General"]["Name"]
-        dropshipper_discount = order["customer"]["OrderOptions"]["WholesaleDiscount"]
-        dropshipper_email = order["customer"]["General"]["Email"]
+        """Create order objects for SellerCloud and get the order's shipping total."""
+        customer = order.customer
 
         # Making sure the skus are in SellerCloud
         skus = self._validate_skus(
-            order["items"], order["purchase_order_number"], dropshipper_name
+            order.items, order.purchase_order_number, customer.name
         )
 
         # If there are no valid skus, skips the order
         if not skus:
             return None, None
 
-        # Formatting the skus to be used in the order object and getting the order's total_price
-        products, order_amounts = self._create_skus(
+        # Formatting the skus to be used in the order object and getting the order's shipping total
+        products, shipping_total = self._create_skus(
             skus,
             sku_shipping_map,
-            order["zip"],
-            order["is_exempt"],
-            order["ships_with_company_account"],
-            dropshipper_discount,
-            order["purchase_order_number"],
+            order.ships_with_company_account,
+            customer.wholesale_discount,
+            order.purchase_order_number,
         )
 
         if products:
             # Creating the order id reference
-            code_length = len(order["dropshipper_code"])
-
-            if (
-                order["purchase_order_number"][:code_length]
-                == order["dropshipper_code"]
-            ):
-                order_id = order["purchase_order_number"]
+            if order.purchase_order_number.startswith(order.dropshipper_code):
+                order_id = order.purchase_order_number
             else:
-                order_id = order["dropshipper_code"] + order["purchase_order_number"]
+                order_id = order.dropshipper_code + order.purchase_order_number
 
             # Preparing shipping details
-            if order["ship_method"] == "UPS Ground":
+            if order.ship_method == "UPS Ground":
                 shipping_details = {
                     "ShippingMethod": "UPSGround",
                     "Carrier": "UPS",
-                    "ShippingFee": order_amounts["shipping_total"],
+                    "ShippingFee": shipping_total,
                     "AllowShippingEvenNotPaid": True,
                 }
-            elif order["ship_method"] == "FEDEX Ground HD":
+            elif order.ship_method == "FEDEX Ground HD":
                 shipping_details = {
                     "ShippingMethod": "FedExGround",
                     "Carrier": "Fedex",
-                    "ShippingFee": order_amounts["shipping_total"],
+                    "ShippingFee": shipping_total,
                     "AllowShippingEvenNotPaid": True,
                 }
 
@@ -69,33 +86,33 @@ class OrderCreator:
             order_obj = {
                 "CustomerDetails": {
                     "ID": sellercloud_id,
-                    "Email": dropshipper_email,
-                    "FirstName": dropshipper_name,
-                    "Business": dropshipper_name,
+                    "Email": customer.email,
+                    "FirstName": customer.name,
+                    "Business": customer.name,
                     "IsWholesale": True,
                 },
                 "OrderDetails": {
                     "CompanyID": 1,  # Placeholder
-                    "TaxExempt": order["is_exempt"],
+                    "TaxExempt": order.is_exempt,
                     "Channel": 21,
                     "OrderSourceOrderID": order_id,
-                    "OrderDate": order["date_added"].strftime("%Y-%m-%d %H:%M:%S"),
+                    "OrderDate": order.date_added.strftime("%Y-%m-%d %H:%M:%S"),
                 },
                 "Products": products,
                 "ShippingAddress": {
-                    "FirstName": order["customer_first_name"],
-                    "LastName": order["customer_last_name"],
-                    "Country": order["country"],
-                    "City": order["city"],
-                    "State": order["state"],
-                    "ZipCode": order["zip"],
-                    "Address": order["address"],
-                    "Phone": order["phone"],
+                    "FirstName": order.customer_first_name,
+                    "LastName": order.customer_last_name,
+                    "Country": order.country,
+                    "City": order.city,
+                    "State": order.state,
+                    "ZipCode": order.zip,
+                    "Address": order.address,
+                    "Phone": order.phone,
                 },
                 "ShippingMethodDetails": shipping_details,
             }
 
-            return order_obj, order_amounts
+            return order_obj, shipping_total
         else:
             return None, None
 
@@ -107,79 +124,56 @@ class OrderCreator:
         discount,
         purchase_order_number,
     ):
-        """Adding the skus to the order object and getting the order totals."""
-        shipping_total = 0
+        """Adding the skus to the order object and getting the order's shipping total."""
+        # The shipping costs are Decimal, so the total is exact before it is rounded
+        shipping_total = Decimal(0)
 
         sku_objs = []
-        order_amounts = {"skus_prices": {}}
 
         for sku in skus:
             # Calculating shipping
             if ships_with_company_account:
-                if sku["sku"] in sku_shipping_map:
-                    sku_shipping_price = sku_shipping_map[sku["sku"]] * sku["quantity"]
+                if sku.sku in sku_shipping_map:
+                    sku_shipping_price = sku_shipping_map[sku.sku] * sku.quantity
                     shipping_total += sku_shipping_price
                 else:
                     send_email(
                         "Error Calculating Shipping",
-                        f"There was an error calculating shipping for order {purchase_order_number}, sku: {sku['sku']} was not found in the ProductCatalog database.",
+                        f"There was an error calculating shipping for order {purchase_order_number}, sku: {sku.sku} was not found in the ProductCatalog database.",
                     )
                     return None, None
             else:
-                shipping_total = 0
+                shipping_total = Decimal(0)
 
             # Adding the sku to the order object
             sku_objs.append(
                 {
-                    "ProductID": sku["sku"],
-                    "Qty": sku["quantity"],
+                    "ProductID": sku.sku,
+                    "Qty": sku.quantity,
                     "DiscountValue": discount,
                     "DiscountType": 1,
                 }
             )
 
-            # order_amounts["skus_prices"][sku["sku"]] = discounted_amount
-
-        # Creating the order totals
-        order_amounts["shipping_total"] = round_to_decimal(shipping_total)
-
-        return sku_objs, order_amounts
+        return sku_objs, round_to_decimal(shipping_total)
 
     def _validate_skus(self, skus, purchase_order_number, dropshipper_name):
-        """Makes sure the skus are in SellerCloud and returns the prices."""
-
-        # Placeholder for the valid and invalid skus
-        valid_skus = []
-        invalid_skus = []
+        """Makes sure the skus are in SellerCloud with a price, returns the order items if they all are."""
 
-        # Separating the valid and invalid skus
-        for sku in skus:
-            if (
-                sku["sku"] in self.skus_in_sellercloud
-                and self.skus_in_sellercloud[sku["sku"]] > 0
-            ):
-                valid_skus.append(
-                    {
-                        "sku": sku["sku"],
-                        "quantity": sku["quantity"],
-                        "unit_price": self.skus_in_sellercloud[sku["sku"]],
-                    }
-                )
-            else:
-                invalid_skus.append({"sku": sku["sku"], "quantity": sku["quantity"]})
+        # The items without a price in SellerCloud
+        invalid_skus = [
+            sku for sku in skus if self.skus_in_sellercloud.get(sku.sku, 0) <= 0
+        ]
 
         # Sending an email with the invalid skus
         if invalid_skus:
             skus_str = ""
             missing_price = False
             for sku in invalid_skus:
-                if (
-                    sku["sku"] in self.skus_in_sellercloud
-                    and self.skus_in_sellercloud[sku["sku"]] <= 0
-                ):
+                if sku.sku in self.skus_in_sellercloud:
                     missing_price = True
 
-                skus_str += f"{sku['sku']} - {sku['quantity']} units\n"
+                skus_str += f"{sku.sku} - {sku.quantity} units\n"
 
             send_missing_parts_error_report(
                 skus_str, purchase_order_number, dropshipper_name, missing_price
@@ -187,32 +181,40 @@ class OrderCreator:
 
             return None
 
-        return valid_skus
+        return skus
 
     def _get_skus_in_sellercloud(self, sku_numbers):
         """Checks to see if a batch of skus are in SellerCloud."""
         # NOTE: This only returns the skus that are in SellerCloud
-        skus_in_sellercloud = {}
+        # Removing the repeated skus and using the prices in the catalog cache that are still fresh
+        sku_numbers = list(dict.fromkeys(sku_numbers))
+        skus_in_sellercloud = self.catalog_cache.get_many(sku_numbers)
+        sku_numbers = [sku for sku in sku_numbers if sku not in skus_in_sellercloud]
+
+        if not sku_numbers:
+            return skus_in_sellercloud
+
         try:
-            # It makes batches of 50 skus to send to SellerCloud
-            while True:
-                if len(sku_numbers) > 50:
-                    batch = [sku_numbers.pop() for _ in range(50)]
-                else:
-                    batch = sku_numbers
-                    sku_numbers = []
+            # The skus are packed into as few requests as the url length allows and every page of the results is read
+            items, errors = self.sc_api.bulk_lookup(
+                "GET_SELLERCLOUD_SKUS", "skus", sku_numbers
+            )
+
+            for error in errors:
+                print(f"Error getting skus from SellerCloud: {error}")
 
-                # Using the previously extracted skus to get the skus from SellerCloud
-                check_sku_data = {"url_args": {"skus": ", ".join(batch)}}
-                response = self.sc_api.execute(check_sku_data, "GET_SELLERCLOUD_SKUS")
+            # Getting the skus and their prices from SellerCloud response
+            refreshed_skus = {sku["ID"]: sku["WholeSalePrice"] for sku in items}
+            skus_in_sellercloud.update(refreshed_skus)
+            self.catalog_cache.set_many(refreshed_skus)
 
-                # Getting the skus and their prices from SellerCloud response
-                if response and response.json():
-                    for sku in response.json()["Items"]:
-                        skus_in_sellercloud[sku["ID"]] = sku["WholeSalePrice"]
+            # When a lookup failed the skus it did not return may still be in SellerCloud
+            if not errors:
+                self.skus_not_in_sellercloud.update(
+                    sku for sku in sku_numbers if sku not in refreshed_skus
+                )
 
-                if not sku_numbers:
-                    return skus_in_sellercloud
+            return skus_in_sellercloud
 
         except Exception as e:
             print(f"Error getting skus from SellerCloud: {e}")
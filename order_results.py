@@ -0,0 +1,30 @@
+from dataclasses import dataclass
+from models import PurchaseOrder
+
+# Statuses an order can end with after going through a batch
+UPLOADED = "uploaded"
+DUPLICATE = "duplicate"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+
+@dataclass(slots=True)
+class OrderResult:
+    """
+    Result of one purchase order in a batch, it keeps a reference to the order so the results never depend on list positions.
+    order_obj is the SellerCloud order object (None for skipped orders) and error the reason the order failed.
+    """
+
+    order: PurchaseOrder
+    order_obj: dict = None
+    status: str = None
+    error: str = None
+
+    @property
+    def order_source_id(self):
+        return self.order_obj["OrderDetails"]["OrderSourceOrderID"]
+
+    @property
+    def in_sellercloud(self):
+        """Checks if the order is in SellerCloud with its sellercloud_order_id, so it can be written back."""
+        return self.status in (UPLOADED, DUPLICATE)
@@ -0,0 +1,164 @@
+import queue
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from batch_steps import build_orders, upload_batch, write_back
+from config import STREAM_CHUNK_SIZE, STREAM_QUEUE_SIZE, UPLOAD_WORKERS
+
+# Marks the end of the items of a stage
+_DONE = object()
+
+
+class StreamingPipeline:
+    """
+    Streams the pending purchase orders from the database to SellerCloud as a chain of generator stages:
+    load -> build -> upload -> write back.
+    The load, build and upload stages run in their own threads connected by bounded queues, so at most a few chunks
+    are in memory at a time and the first orders are uploaded while the rest are still being read.
+    The write back runs in the calling thread, which owns the ExampleDb connection.
+    """
+
+    def __init__(
+        self,
+        ex_db,
+        sc_api,
+        creator,
+        customer_directory,
+        sku_shipping_map,
+        chunk_size=STREAM_CHUNK_SIZE,
+        queue_size=STREAM_QUEUE_SIZE,
+        workers=UPLOAD_WORKERS,
+    ):
+        self.ex_db = ex_db
+        self.sc_api = sc_api
+        self.creator = creator
+        self.customer_directory = customer_directory
+        self.sku_shipping_map = sku_shipping_map
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.workers = workers
+        self.failed = threading.Event()
+        self.errors = []
+        self.high_water_mark = None
+
+    def run(self):
+        """Runs the pipeline until every pending purchase order went through it."""
+        loaded = queue.Queue(self.queue_size)
+        built = queue.Queue(self.queue_size)
+        uploaded = queue.Queue(self.queue_size)
+
+        threads = [
+            self._start("load", self._load(), loaded),
+            self._start("build", self._build(self._drain(loaded)), built),
+            self._start("upload", self._upload(self._drain(built)), uploaded),
+        ]
+
+        try:
+            for results in self._drain(uploaded):
+                write_back(self.ex_db, results)
+        except Exception as e:
+            self.errors.append(e)
+            self.failed.set()
+
+        for thread in threads:
+            thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+        # Every loaded order was evaluated, so the next run starts after them
+        self.ex_db.save_watermark(self.high_water_mark)
+
+    def _load(self):
+        """Reads the pending purchase orders in chunks, using its own database connection."""
+        loader_db = type(self.ex_db)()
+
+        try:
+            yield from loader_db.iter_purchase_orders_not_in_sellercloud(
+                self.chunk_size
+            )
+            self.high_water_mark = loader_db.high_water_mark
+        finally:
+            loader_db.close()
+
+    def _build(self, chunks):
+        """Creates the order objects of each chunk, checking its customers and skus first."""
+        for chunk in chunks:
+            orders_by_dropshipper = defaultdict(list)
+            for po in chunk:
+                orders_by_dropshipper[po.sellercloud_customer_id].append(po)
+
+            customers = self.customer_directory.get_customers(
+                orders_by_dropshipper.keys()
+            )
+            self.creator.load_skus([item.sku for po in chunk for item in po.items])
+
+            results = []
+
+            for sellercloud_id, orders in orders_by_dropshipper.items():
+                # Every order of the dropshipper shares the same customer
+                for order in orders:
+                    order.customer = customers[sellercloud_id]
+
+                results.extend(
+                    build_orders(
+                        self.creator, orders, sellercloud_id, self.sku_shipping_map
+                    )
+                )
+
+            yield results
+
+    def _upload(self, batches):
+        """Uploads the orders of each chunk concurrently, see upload_batch."""
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for results in batches:
+                upload_batch(executor, self.sc_api, results)
+
+                yield results
+
+    def _start(self, name, items, outbox):
+        """Runs a stage in a thread, putting its items in the outbox."""
+        thread = threading.Thread(
+            target=self._run_stage, args=(items, outbox), name=name, daemon=True
+        )
+        thread.start()
+        return thread
+
+    def _run_stage(self, items, outbox):
+        try:
+            for item in items:
+                # Stopping as soon as another stage failed, instead of reading the rest of the backlog
+                if not self._put(outbox, item):
+                    break
+        except Exception as e:
+            self.errors.append(e)
+            self.failed.set()
+        finally:
+            # Closing the stage releases what it holds, like the load stage's cursor and connection
+            items.close()
+            self._put(outbox, _DONE)
+
+    def _put(self, outbox, item):
+        """Waits for room in the outbox, unless another stage failed.
+        Returns False if the item was not put because another stage failed."""
+        while not self.failed.is_set():
+            try:
+                outbox.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def _drain(self, inbox):
+        """Yields the items of the inbox until the previous stage is done or another stage failed."""
+        while not self.failed.is_set():
+            try:
+                item = inbox.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            if item is _DONE:
+                return
+
+            yield item
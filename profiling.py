@@ -0,0 +1,221 @@
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from functools import wraps
+from config import PROFILE_DIR, PROFILE_SNAPSHOTS
+
+
+class Profiler:
+    """
+    Profiles the stages of one run with cProfile and tracemalloc and writes a report per stage.
+    Nothing is profiled until instrument wraps a function in a stage, so a run that does not profile pays nothing.
+    cProfile only follows the thread that enabled it, so a profiled run has to do all its work in the calling thread.
+    When a stage runs inside another one, the outer stage's profile is paused, so each hot function table only
+    has the time of its own stage. The allocations of a stage include the ones of the stages inside it.
+    """
+
+    def __init__(self, report_dir=PROFILE_DIR, snapshots=PROFILE_SNAPSHOTS):
+        self.report_dir = os.path.join(
+            report_dir, datetime.now().strftime("%Y%m%d-%H%M%S")
+        )
+        # Number of calls of every stage that are compared with tracemalloc snapshots, they are slow to take
+        self.snapshots = snapshots
+        self.thread = threading.get_ident()
+        self.stages = {}
+        self.active = []
+        self.instrumented = []
+        # Seconds spent taking snapshots, they are left out of the time of the stages
+        self.overhead = 0.0
+
+    def start(self):
+        tracemalloc.start(10)
+
+    def instrument(self, owner, name, stage=None):
+        """Replaces the function owner.name with a wrapper that profiles it in the stage, stage defaults to the name."""
+        function = getattr(owner, name)
+        stage = stage or name
+
+        @wraps(function)
+        def profiled(*args, **kwargs):
+            with self.stage(stage):
+                return function(*args, **kwargs)
+
+        self.instrumented.append((owner, name, owner.__dict__.get(name)))
+        setattr(owner, name, profiled)
+
+    def restore(self):
+        """Puts back the functions replaced by instrument."""
+        for owner, name, original in reversed(self.instrumented):
+            if original is None:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, original)
+
+        self.instrumented = []
+
+    def stage(self, name):
+        if threading.get_ident() != self.thread:
+            return _NullStage()
+
+        return _Stage(self, name)
+
+    def stop(self):
+        """Stops profiling, writes the reports and returns the folder they were written to."""
+        self.restore()
+        tracemalloc.stop()
+        os.makedirs(self.report_dir, exist_ok=True)
+
+        summary = []
+
+        for name, stage in sorted(
+            self.stages.items(), key=lambda item: item[1]["seconds"], reverse=True
+        ):
+            summary.append(
+                f"{name:<24}{stage['calls']:>10}{stage['seconds']:>14.3f}"
+                f"{stage['allocated'] / 1024 / 1024:>16.2f}"
+            )
+            self._write_stage(name, stage)
+
+        with open(os.path.join(self.report_dir, "summary.txt"), "w") as file:
+            file.write(
+                f"{'stage':<24}{'calls':>10}{'seconds':>14}{'allocated MB':>16}\n"
+            )
+            file.write("\n".join(summary) + "\n")
+
+        return self.report_dir
+
+    def _write_stage(self, name, stage):
+        """Writes the hot functions and the top allocation sites of a stage, and its raw stats for other viewers."""
+        stage["profile"].dump_stats(os.path.join(self.report_dir, f"{name}.prof"))
+
+        output = io.StringIO()
+        output.write(
+            f"Stage: {name}\nCalls: {stage['calls']}\nSeconds: {stage['seconds']:.3f}\n\n"
+        )
+
+        stats = pstats.Stats(stage["profile"], stream=output)
+        stats.sort_stats("cumulative").print_stats(30)
+        stats.sort_stats("tottime").print_stats(30)
+
+        output.write(
+            f"Top allocation sites (first {self.snapshots} calls, net bytes):\n"
+        )
+        allocations = sorted(
+            stage["allocations"].items(), key=lambda item: item[1][0], reverse=True
+        )
+        for (filename, lineno), (size, count) in allocations[:20]:
+            output.write(
+                f"{size / 1024:>12.1f} KiB {count:>8} blocks  {filename}:{lineno}\n"
+            )
+
+        with open(os.path.join(self.report_dir, f"{name}.txt"), "w") as file:
+            file.write(output.getvalue())
+
+    def _get_stage(self, name):
+        return self.stages.setdefault(
+            name,
+            {
+                "profile": cProfile.Profile(),
+                "calls": 0,
+                "seconds": 0.0,
+                "allocated": 0,
+                "allocations": {},
+            },
+        )
+
+
+class _Stage:
+    """Profiles one call of a stage."""
+
+    # Allocations made by the profiler itself are left out of the reports
+    filters = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    )
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.stage = profiler._get_stage(name)
+        self.snapshot = None
+
+    def __enter__(self):
+        profiler = self.profiler
+
+        # Pausing the outer stage so its table does not count this one
+        if profiler.active:
+            profiler.active[-1]["profile"].disable()
+        profiler.active.append(self.stage)
+
+        if self.stage["calls"] < profiler.snapshots:
+            started = time.perf_counter()
+            self.snapshot = tracemalloc.take_snapshot().filter_traces(self.filters)
+            profiler.overhead += time.perf_counter() - started
+
+        self.memory = tracemalloc.get_traced_memory()[0]
+        self.overhead = profiler.overhead
+        self.started = time.perf_counter()
+        self.stage["profile"].enable()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stage["profile"].disable()
+        profiler = self.profiler
+
+        self.stage["calls"] += 1
+        self.stage["seconds"] += (
+            time.perf_counter() - self.started - (profiler.overhead - self.overhead)
+        )
+        self.stage["allocated"] += max(
+            tracemalloc.get_traced_memory()[0] - self.memory, 0
+        )
+
+        if self.snapshot is not None:
+            started = time.perf_counter()
+            snapshot = tracemalloc.take_snapshot().filter_traces(self.filters)
+            for diff in snapshot.compare_to(self.snapshot, "lineno"):
+                if diff.size_diff <= 0:
+                    continue
+
+                frame = diff.traceback[0]
+                size, count = self.stage["allocations"].get(
+                    (frame.filename, frame.lineno), (0, 0)
+                )
+                self.stage["allocations"][(frame.filename, frame.lineno)] = (
+                    size + diff.size_diff,
+                    count + diff.count_diff,
+                )
+
+            profiler.overhead += time.perf_counter() - started
+
+        profiler.active.pop()
+        if profiler.active:
+            profiler.active[-1]["profile"].enable()
+
+        return False
+
+
+class _NullStage:
+    """Stage used outside the profiled thread, cProfile can not follow it there."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+class SerialExecutor:
+    """Stand-in for ThreadPoolExecutor that runs every call in the calling thread, it is used while profiling."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def map(self, function, *iterables):
+        return map(function, *iterables)
@@ -0,0 +1,249 @@
+import asyncio
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from config import SELLERCLOUD_RATE_LIMIT, SELLERCLOUD_RETRY
+
+# Status codes SellerCloud uses when it is throttling the requests
+THROTTLE_STATUSES = {429, 503}
+
+# Status codes that are worth retrying
+RETRY_STATUSES = {429, 502, 503, 504}
+
+# Longest sleep of a request waiting for a token, after it the rate and the pause are checked again
+MAX_TOKEN_WAIT = 1.0
+
+
+class TokenBucket:
+    """
+    Token bucket that limits the requests per second sent to one endpoint.
+    It lets every request through until the endpoint throttles for the first time, then the rate starts a step below
+    the rate the requests were being sent at. The rate is cut by decrease at most once every cooldown seconds while the
+    endpoint throttles, and raised by increase requests per second for every second it does not, so it settles at the
+    highest rate the endpoint accepts. Once it climbs back to max_rate the limit is lifted again.
+    The waiting requests take a ticket and get the tokens in ticket order. A token is only taken when the request
+    is about to be sent, and the waits are worked out again after every sleep, so the requests that are waiting
+    follow the rate changes and the Retry-After pauses that come in meanwhile.
+    """
+
+    def __init__(
+        self,
+        min_rate,
+        max_rate,
+        burst,
+        increase,
+        decrease,
+        cooldown,
+    ):
+        # None while the endpoint did not throttle, the requests are not limited then
+        self.rate = None
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.decreased_at = None
+        # Requests sent in the current second and the rate of the last full second, the rate starts from them
+        self.window_started = self.updated
+        self.window_sent = 0
+        self.sent_rate = 0.0
+        self.next_ticket = 0
+        # Oldest ticket that did not get its token yet, and the newer ones that already got it or gave up
+        self.serving = 0
+        self.done = set()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is taken, the request has to be sent right after."""
+        ticket = self._take_ticket()
+        try:
+            while (wait := self._try_acquire(ticket)) > 0:
+                time.sleep(wait)
+        except BaseException:
+            self._finish(ticket)
+            raise
+
+    async def acquire_async(self):
+        """Async counterpart of acquire."""
+        ticket = self._take_ticket()
+        try:
+            while (wait := self._try_acquire(ticket)) > 0:
+                await asyncio.sleep(wait)
+        except BaseException:
+            # A cancelled request gives up its turn
+            self._finish(ticket)
+            raise
+
+    def _take_ticket(self):
+        with self.lock:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            return ticket
+
+    def _try_acquire(self, ticket):
+        """Takes a token for the ticket and returns 0 if its turn came, else the seconds to wait before trying again."""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+
+            if self.rate is None:
+                if now >= self.paused_until:
+                    self._sent(ticket, now)
+                    return 0
+
+                return min(max(self.paused_until - now, 0.001), MAX_TOKEN_WAIT)
+
+            # The tickets before this one that are still waiting get their tokens first
+            ahead = ticket - self.serving
+
+            if now >= self.paused_until and self.tokens >= ahead + 1:
+                self.tokens -= 1
+                self._sent(ticket, now)
+                return 0
+
+            wait = max(self.paused_until - now, (ahead + 1 - self.tokens) / self.rate)
+            return min(max(wait, 0.001), MAX_TOKEN_WAIT)
+
+    def _refill(self, now):
+        """Adds the tokens and raises the rate for the time since the last update."""
+        elapsed = now - self.updated
+        self.updated = now
+
+        if self.rate is None:
+            return
+
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+
+        # The rate only goes up while the endpoint is not paused
+        if now >= self.paused_until:
+            self.rate += self.increase * elapsed
+
+            if self.rate >= self.max_rate:
+                self.rate = None
+
+    def _sent(self, ticket, now):
+        """Counts a request that got its turn, so the rate it was sent at is known when the endpoint throttles."""
+        if now - self.window_started >= 1.0:
+            self.sent_rate = self.window_sent / (now - self.window_started)
+            self.window_started = now
+            self.window_sent = 0
+
+        self.window_sent += 1
+        self._finish_locked(ticket)
+
+    def _finish(self, ticket):
+        with self.lock:
+            self._finish_locked(ticket)
+
+    def _finish_locked(self, ticket):
+        self.done.add(ticket)
+        while self.serving in self.done:
+            self.done.remove(self.serving)
+            self.serving += 1
+
+    def throttled(self, retry_after=None):
+        """Lowers the rate and pauses the endpoint for the Retry-After seconds if there are any.
+        The throttled responses of the requests that were in flight together only lower the rate once.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+            if (
+                self.decreased_at is not None
+                and now - self.decreased_at < self.cooldown
+            ):
+                return
+
+            if self.rate is None:
+                # Starting from the rate the requests were sent at, this second or the last one
+                elapsed = max(now - self.window_started, 1.0)
+                self.rate = max(self.sent_rate, self.window_sent / elapsed)
+                self.tokens = 0
+
+            self.rate = min(
+                self.max_rate, max(self.min_rate, self.rate * self.decrease)
+            )
+            self.decreased_at = now
+
+
+class RateLimiter:
+    """Keeps one TokenBucket per endpoint, the buckets are created the first time an endpoint is used."""
+
+    def __init__(self, settings=SELLERCLOUD_RATE_LIMIT):
+        self.settings = settings
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, endpoint):
+        with self.lock:
+            if endpoint not in self.buckets:
+                self.buckets[endpoint] = TokenBucket(**self.settings)
+            return self.buckets[endpoint]
+
+
+class RetryPolicy:
+    """
+    Decides if a failed request is retried and how long to wait before doing it.
+    The waits grow exponentially with random jitter, and the total number of retries is limited by a budget
+    shared by all the requests, so an outage does not turn into endless retries.
+    """
+
+    def __init__(self, settings=SELLERCLOUD_RETRY):
+        self.max_attempts = settings["max_attempts"]
+        self.base_delay = settings["base_delay"]
+        self.max_delay = settings["max_delay"]
+        self.settings = settings
+        self.budget = settings["budget"]
+        self.lock = threading.Lock()
+
+    def reset(self):
+        """Gives back the whole budget, long running processes call it at the start of every run."""
+        with self.lock:
+            self.budget = self.settings["budget"]
+
+    def can_retry(self, attempt):
+        """Checks if there is another attempt left and takes a retry from the budget."""
+        if attempt >= self.max_attempts:
+            return False
+
+        with self.lock:
+            if self.budget <= 0:
+                return False
+            self.budget -= 1
+            return True
+
+    def backoff(self, attempt, retry_after=None):
+        """Returns the seconds to wait before the next attempt, honoring the Retry-After seconds if there are any."""
+        # Retry-After: 0 means the request can be sent again right away
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+
+        # Full jitter spreads the retries of the concurrent requests
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+def parse_retry_after(value):
+    """Converts a Retry-After header, in seconds or as an HTTP date, to seconds."""
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_date = parsedate_to_datetime(value)
+        return max(0.0, (retry_date - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
@@ -1,36 +1,106 @@
 import requests
+from requests.exceptions import ConnectionError
+import threading
+import time
+from collections import OrderedDict
 from email_helper import send_email
+from local_cache import LocalCache
+from metrics import metrics
+import transport
+from config import TAX_RATE_CACHE_TTL, TAX_RATE_CACHE_SIZE
 
 
 class SalesTaxApi:
-    def __init__(self, zip_tax_api_key):
+    """
+    Gets sales tax rates from the Zip-Tax API.
+    The rates are cached by 5 digit zip code, in memory (up to cache_size zip codes) and on disk for ttl seconds,
+    so each zip code is only requested once per ttl.
+    """
+
+    def __init__(
+        self, zip_tax_api_key, ttl=TAX_RATE_CACHE_TTL, cache_size=TAX_RATE_CACHE_SIZE
+    ):
         self.api_key = zip_tax_api_key
+        self.cache_size = cache_size
+        self.rates = OrderedDict()
+        self.lock = threading.Lock()
+        self.cache = LocalCache("tax_rates", ttl)
+        # The requests go through the recording or replaying transport when one is set up
+        self.http = transport.wrap(requests, "zip_tax")
 
     def get_tax_rate(self, postalcode):
         if len(postalcode) > 5:
             postalcode = postalcode[:5]
 
+        # Using the rate in memory
+        with self.lock:
+            if postalcode in self.rates:
+                self.rates.move_to_end(postalcode)
+                return self.rates[postalcode]
+
+        # Using the rate stored on disk
+        cached = self.cache.get_many([postalcode])
+        if postalcode in cached:
+            self._remember(postalcode, cached[postalcode])
+            return cached[postalcode]
+
+        rate = self._request_tax_rate(postalcode)
+
+        # Failed lookups are not cached so they are tried again
+        if rate is None:
+            return 0.0
+
+        self.cache.set_many({postalcode: rate})
+        self._remember(postalcode, rate)
+
+        return rate
+
+    def _remember(self, postalcode, rate):
+        """Stores a rate in memory, removing the least recently used one when the cache is full."""
+        with self.lock:
+            self.rates[postalcode] = rate
+            self.rates.move_to_end(postalcode)
+
+            while len(self.rates) > self.cache_size:
+                self.rates.popitem(last=False)
+
+    def _request_tax_rate(self, postalcode):
+        """Requests the tax rate of a zip code, returns None if it could not be obtained."""
         url = f"https://api.zip-tax.com/request/v40?key={self.api_key}&postalcode={postalcode}"
         max_attempts = 3
         timeout = 10
 
         for attempt in range(max_attempts):
+            started = time.perf_counter()
             try:
-                response = requests.get(url, timeout=timeout)
+                response = self.http.get(url, timeout=timeout)
+                metrics.record_request(
+                    "zip_tax",
+                    "GET /request/v40",
+                    response.status_code,
+                    time.perf_counter() - started,
+                )
 
                 return response.json()["results"][0]["taxSales"]
             except ConnectionError as e:
+                metrics.record_request(
+                    "zip_tax",
+                    "GET /request/v40",
+                    "error",
+                    time.perf_counter() - started,
+                )
                 if attempt < max_attempts - 1:
+                    metrics.record_retry("zip_tax", "GET /request/v40")
                     continue
                 else:
                     send_email(
                         "Tax Calculation",
-                        f"Error getting tax rate for {self.po}-{postalcode}\n\n{e}",
+                        f"Error getting tax rate for {postalcode}\n\n{e}",
                     )
-                return 0.0
+                return None
             except Exception as e:
                 send_email(
                     "Tax Calculation",
-                    f"Error getting tax rate for {self.po}-{postalcode}\n\n{e}",
+                    f"Error getting tax rate for {postalcode}\n\n{e}",
                 )
-                return 0.0
+                return None
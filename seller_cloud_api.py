@@ -1,8 +1,32 @@
 import requests
-from requests.exceptions import HTTPError, Timeout, RequestException
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, HTTPError, Timeout, RequestException
 from email_helper import send_email
-from urllib.parse import quote
-from config import sellercloud_credentials, sellercloud_endpoints
+from metrics import metrics
+from token_cache import TokenCache
+import transport
+from rate_limiter import (
+    RateLimiter,
+    RetryPolicy,
+    parse_retry_after,
+    RETRY_STATUSES,
+    THROTTLE_STATUSES,
+)
+from urllib.parse import quote, urlsplit
+from config import (
+    sellercloud_credentials,
+    sellercloud_endpoints,
+    SELLERCLOUD_POOL_SIZE,
+    SELLERCLOUD_MAX_URL_LENGTH,
+    SELLERCLOUD_LOOKUP_PAGE_SIZE,
+    SELLERCLOUD_LOOKUP_WORKERS,
+)
+
+# Largest page number a paged lookup follows, its digits are counted in the length of the urls of a bulk lookup
+MAX_PAGE_NUMBER = 9999
 
 
 class SellerCloudAPI:
@@ -17,14 +41,81 @@ class SellerCloudAPI:
         "endpoint_error_message": the error message fragment to be displayed if the request fails in the format "while (the action it was performing): ",
         "success_message": the success message to be displayed if the request is successful in the format "(API name) (action it was performing) successfully!",
     },
+    All the requests go through one keep-alive session, its connection pool is safe to share between threads.
+    Creating it makes no request, the access token is taken from the TokenCache or fetched by the first request that needs it,
+    and it is replaced before it expires or when SellerCloud rejects it.
     """
 
-    def __init__(self):
+    def __init__(self, pool_size=SELLERCLOUD_POOL_SIZE):
         self.data = sellercloud_credentials
         self.endpoints = sellercloud_endpoints
+        self.session = transport.wrap(self._create_session(pool_size), "sellercloud")
+        self.rate_limiter = RateLimiter()
+        self.retry_policy = RetryPolicy()
+        # A recorded or replayed run gets its own token, so the token request is in the cassette
+        self.token_cache = TokenCache(
+            self.data["Username"], persist=not transport.settings["mode"]
+        )
+        self.token = None
+        self.token_expires_at = 0
+        self.headers = None
+        # Only one thread gets a new token, the others wait for it
+        self.token_lock = threading.Lock()
+
+    def refresh_token(self):
+        """Gets a new access token from SellerCloud and saves it for the next runs."""
+        with self.token_lock:
+            self._fetch_token()
+
+    def _current_headers(self):
+        """Returns the headers with a token that is not about to expire, getting one first if there is none.
+        The token saved by an earlier run or by another worker is used while it is fresh.
+        """
+        headers = self.headers
+        if headers is not None and self.token_cache.is_fresh(self.token_expires_at):
+            return headers
+
+        with self.token_lock:
+            if self.headers is None or not self.token_cache.is_fresh(
+                self.token_expires_at
+            ):
+                cached = self.token_cache.load()
+                if cached:
+                    self._set_token(*cached)
+                else:
+                    self._fetch_token()
+
+            return self.headers
+
+    def _replace_token(self, rejected_headers):
+        """Gets a new token after SellerCloud rejected the one in rejected_headers with a 401.
+        Only the first thread that got the 401 gets it, the others use the token it got.
+        A token that another worker saved after the rejected one is used instead of getting a new one.
+        """
+        with self.token_lock:
+            if self.headers is rejected_headers:
+                cached = self.token_cache.load(rejected=self.token)
+                if cached:
+                    self._set_token(*cached)
+                else:
+                    self._fetch_token()
+
+            return self.headers
+
+    def _fetch_token(self):
         response = self.execute(self.data, "GET_TOKEN")
-        self.token = response.json()["access_token"]
-        self.headers = {"Authorization": f"Bearer {self.token}"}
+
+        if response is None or response.status_code != 200:
+            raise Exception("Could not get an access token from the SellerCloud API")
+
+        token, expires_at = self.token_cache.parse(response.json())
+        self.token_cache.save(token, expires_at)
+        self._set_token(token, expires_at)
+
+    def _set_token(self, token, expires_at):
+        self.token = token
+        self.token_expires_at = expires_at
+        self.headers = {"Authorization": f"Bearer {token}"}
 
     def execute(self, data, action):
         """Executes a request to the SellerCloud API.
@@ -42,11 +133,82 @@ class SellerCloudAPI:
         if not config:
             raise ValueError("Invalid API action")
 
+        # The token request is sent without the old token, the other requests keep using it meanwhile
         if action == "GET_TOKEN":
-            self.headers = None
             return self.perform_request(self.data, **config)
 
-        return self.perform_request(data, **config)
+        # The data is copied because perform_request takes the url_args out of it, and it may be sent twice
+        headers = self._current_headers()
+        response = self.perform_request(dict(data), **config, headers=headers)
+
+        # The token expired or was revoked, the request is sent once more with a new one
+        if response is not None and response.status_code == 401:
+            print("SellerCloud rejected the access token, getting a new one.")
+            headers = self._replace_token(headers)
+            response = self.perform_request(dict(data), **config, headers=headers)
+
+        return response
+
+    def get_all_pages(self, url_args, action, page_size=SELLERCLOUD_LOOKUP_PAGE_SIZE):
+        """Executes a paged GET request following every page of the results, up to MAX_PAGE_NUMBER pages.
+        The url_args are used in every page with the page_size and the page_number of the page added.
+        Returns the items of all the pages and the error of the page that failed, if any.
+        """
+        items = []
+        page_number = 1
+
+        while True:
+            response = self.execute(
+                {
+                    "url_args": {
+                        **url_args,
+                        "page_size": page_size,
+                        "page_number": page_number,
+                    }
+                },
+                action,
+            )
+
+            if response is None or response.status_code != 200:
+                return items, response.text if response is not None else "No response"
+
+            body = response.json()
+            items.extend(body.get("Items", []))
+
+            if is_last_page(body, len(items), page_size):
+                return items, None
+
+            # A server that ignores the page number would send the same page forever
+            if page_number >= MAX_PAGE_NUMBER:
+                return items, f"{action} had more than {MAX_PAGE_NUMBER} pages"
+
+            page_number += 1
+
+    def bulk_lookup(
+        self,
+        action,
+        ids_arg,
+        ids,
+        page_size=SELLERCLOUD_LOOKUP_PAGE_SIZE,
+        workers=SELLERCLOUD_LOOKUP_WORKERS,
+    ):
+        """Looks up a list of ids with a paged GET endpoint that takes them comma separated in the ids_arg url arg.
+        The ids are packed into as few requests as fit under SELLERCLOUD_MAX_URL_LENGTH, the requests run concurrently
+        and every page of their results is followed.
+        Returns the items found and the errors of the requests that failed.
+        """
+        chunks = chunk_ids(self.endpoints[action]["url"], ids_arg, ids, page_size)
+
+        def lookup(chunk):
+            return self.get_all_pages({ids_arg: ",".join(chunk)}, action, page_size)
+
+        if len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+                pages = list(executor.map(lookup, chunks))
+        else:
+            pages = [lookup(chunk) for chunk in chunks]
+
+        return merge_pages(pages)
 
     def perform_request(
         self,
@@ -55,39 +217,53 @@ class SellerCloudAPI:
         url,
         endpoint_error_message,
         success_message,
+        headers=None,
     ):
-        """Performs a request to the SellerCloud API."""
+        """Performs a request to the SellerCloud API.
+        The request waits for the endpoint's rate limiter, and connection errors, timeouts and throttled or
+        unavailable responses are retried with backoff while the retry policy allows it.
+        """
         error_message = None
-        max_attempts = 3
         timeout = 1000
 
-        for attempt in range(max_attempts):
-            try:
-                url_args = data.pop("url_args", None)
+        # Every endpoint has its own rate limit, the url template identifies the endpoint
+        bucket = self.rate_limiter.bucket(url)
+        endpoint = f"{type.upper()} {urlsplit(url).path}"
 
-                if url_args:
-                    formatted_url = self._sanitize_url(url, url_args)
-                else:
-                    formatted_url = url
+        url_args = data.pop("url_args", None)
+
+        if url_args:
+            formatted_url = self._sanitize_url(url, url_args)
+        else:
+            formatted_url = url
+
+        attempt = 0
+
+        while True:
+            bucket.acquire()
 
-                request_function = getattr(requests, type)
+            attempt += 1
+            error_message = None
+            response = None
+            retry_after = None
+            retry = False
+            started = time.perf_counter()
+
+            try:
+                request_function = getattr(self.session, type)
 
                 response = request_function(
-                    formatted_url, headers=self.headers, json=data, timeout=timeout
+                    formatted_url, headers=headers, json=data, timeout=timeout
                 )
-                break
             except ConnectionError:
-                if attempt < max_attempts - 1:
-                    continue
-                else:
-                    error_message = (
-                        f"Connection error occurred {endpoint_error_message}"
-                    )
+                retry = True
+                error_message = f"Connection error occurred {endpoint_error_message}"
             except HTTPError as http_err:
                 error_message = (
                     f"HTTP error occurred {endpoint_error_message}{http_err}"
                 )
             except Timeout:
+                retry = True
                 error_message = f"Timeout occurred {endpoint_error_message}"
             except RequestException as err:
                 error_message = f"Other error occurred {endpoint_error_message}{err}"
@@ -95,6 +271,26 @@ class SellerCloudAPI:
                 error_message = (
                     f"An unexpected error occurred {endpoint_error_message}{e}"
                 )
+            else:
+                if response.status_code in THROTTLE_STATUSES:
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    bucket.throttled(retry_after)
+
+                retry = response.status_code in RETRY_STATUSES
+
+            metrics.record_request(
+                "sellercloud",
+                endpoint,
+                response.status_code if response is not None else "error",
+                time.perf_counter() - started,
+            )
+
+            if not retry or not self.retry_policy.can_retry(attempt):
+                break
+
+            metrics.record_retry("sellercloud", endpoint)
+
+            time.sleep(self.retry_policy.backoff(attempt, retry_after))
 
         if error_message:
             print(error_message)
@@ -110,7 +306,97 @@ class SellerCloudAPI:
             print(success_message)
             return response
 
+    def close(self):
+        """Closes the connections kept open by the session."""
+        self.session.close()
+
+    def _create_session(self, pool_size):
+        """Creates the session used by every endpoint, with a pool of keep-alive connections and shared headers."""
+        session = requests.Session()
+
+        # Blocking when the pool is exhausted makes extra threads wait for a connection instead of opening throwaway ones
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, pool_block=True
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        session.headers.update(
+            {
+                "Accept": "application/json",
+                "Accept-Encoding": "gzip, deflate",
+                "Connection": "keep-alive",
+            }
+        )
+
+        return session
+
     def _sanitize_url(self, url, url_args):
         """Constructs a URL for a  API request."""
         sanitized_url_args = {k: quote(str(v)) for k, v in url_args.items()}
         return url.format(**sanitized_url_args)
+
+
+def chunk_ids(url, ids_arg, ids, page_size, max_length=SELLERCLOUD_MAX_URL_LENGTH):
+    """Splits the ids, without repeats, into the fewest chunks whose url stays under max_length once they are joined
+    with commas and url encoded. An id that does not fit under max_length on its own gets a chunk anyway.
+    """
+    ids = [str(id) for id in dict.fromkeys(ids)]
+
+    # Length of the url without any id, with the longest page number
+    base_length = len(
+        url.format(
+            **{ids_arg: "", "page_size": page_size, "page_number": MAX_PAGE_NUMBER}
+        )
+    )
+    separator_length = len(quote(","))
+
+    chunks = []
+    chunk = []
+    length = base_length
+
+    for id in ids:
+        id_length = len(quote(id))
+        added = id_length + (separator_length if chunk else 0)
+
+        if chunk and length + added > max_length:
+            chunks.append(chunk)
+            chunk = []
+            length = base_length
+            added = id_length
+
+        chunk.append(id)
+        length += added
+
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
+
+def is_last_page(body, loaded, page_size):
+    """Checks if a page of a paged GET response is the last one, once the loaded items reach its TotalResults.
+    The items are counted instead of the pages, since the server may send less items per page than page_size.
+    Without TotalResults the last page is the one with less items than the page size.
+    """
+    page = body.get("Items", [])
+    total_results = body.get("TotalResults")
+
+    if total_results is None:
+        return len(page) < page_size
+
+    # An empty page ends the results too, even if TotalResults says there are more
+    return not page or loaded >= total_results
+
+
+def merge_pages(pages):
+    """Merges the (items, error) results of get_all_pages into all the items and the list of errors."""
+    items = []
+    errors = []
+
+    for page_items, error in pages:
+        items.extend(page_items)
+        if error:
+            errors.append(error)
+
+    return items, errors
@@ -0,0 +1,103 @@
+import os
+import socket
+import threading
+import time
+from config import SHARD_LEASE_TTL
+
+
+class ShardLease:
+    """
+    Lease on the purchase orders of one dropshipper (a shard), kept in the SellerCloudUploadLeases table.
+    Only the worker holding the lease uploads the dropshipper's orders, so two workers never upload the same purchase order.
+    The lease expires after ttl seconds unless it is renewed, so the shard of a worker that crashed is picked up by another one.
+    While it is held a heartbeat thread renews it every third of the ttl, so a slow batch does not let it expire.
+    It is passed to the uploaders as their stop_event: is_set is True once the worker is stopping or the lease was lost.
+    """
+
+    def __init__(
+        self,
+        ex_db,
+        sellercloud_customer_id,
+        owner,
+        completed_since,
+        ttl=SHARD_LEASE_TTL,
+        stop_event=None,
+    ):
+        self.ex_db = ex_db
+        self.sellercloud_customer_id = sellercloud_customer_id
+        self.owner = owner
+        self.completed_since = completed_since
+        self.ttl = ttl
+        self.stop_event = stop_event
+        self.renewed_at = None
+        self.lost = False
+        self.released = threading.Event()
+        self.heartbeat = None
+
+    def acquire(self):
+        acquired = self.ex_db.acquire_lease(
+            self.sellercloud_customer_id, self.owner, self.ttl, self.completed_since
+        )
+
+        if acquired:
+            self.renewed_at = time.monotonic()
+
+        return acquired
+
+    def start_heartbeat(self, heartbeat_db):
+        """Renews the lease from a thread until it is released, heartbeat_db is a connection only used by that thread."""
+        self.heartbeat = threading.Thread(
+            target=self._renew_until_released,
+            args=(heartbeat_db,),
+            name=f"lease-{self.sellercloud_customer_id}",
+            daemon=True,
+        )
+        self.heartbeat.start()
+
+    def _renew_until_released(self, heartbeat_db):
+        while not self.lost and not self.released.wait(self.ttl / 3):
+            try:
+                renewed = heartbeat_db.renew_lease(
+                    self.sellercloud_customer_id, self.owner, self.ttl
+                )
+            except Exception as e:
+                # The lease is renewed on the next beat, it is only lost once it expires
+                print(
+                    f"Could not renew the lease of dropshipper {self.sellercloud_customer_id}: {e}"
+                )
+                continue
+
+            if renewed:
+                self.renewed_at = time.monotonic()
+            else:
+                print(
+                    f"Lost the lease of dropshipper {self.sellercloud_customer_id}, another worker took it."
+                )
+                self.lost = True
+
+    def is_set(self):
+        """Returns True if the worker is stopping or the lease was lost or expired without being renewed."""
+        if self.stop_event and self.stop_event.is_set():
+            return True
+
+        # Another worker can take the lease once it expired, even if it was not taken yet
+        if not self.lost and time.monotonic() - self.renewed_at >= self.ttl:
+            print(
+                f"The lease of dropshipper {self.sellercloud_customer_id} expired before it was renewed."
+            )
+            self.lost = True
+
+        return self.lost
+
+    def release(self):
+        self.released.set()
+        if self.heartbeat:
+            self.heartbeat.join()
+
+        if not self.lost:
+            self.ex_db.release_lease(self.sellercloud_customer_id, self.owner)
+
+
+def worker_name(index):
+    """Name of a worker that is unique across the machines running workers."""
+    return f"{socket.gethostname()}:{os.getpid()}:{index}"
@@ -0,0 +1,116 @@
+import json
+import os
+from bisect import bisect_left
+from decimal import Decimal
+from config import CACHE_DIR
+
+
+class ShippingMap:
+    """
+    Compact, read only map of skus and aliases to their shipping cost.
+    The keys are kept in a sorted tuple and the costs in a parallel tuple of their exact decimal strings
+    ("" when the cost is not set), so a large catalog takes a fraction of the memory of a dict and the costs
+    are returned as Decimal without a float rounding. It is saved in CACHE_DIR together with the
+    checksum of the catalog it was built from, so it is only rebuilt when the catalog changes.
+    """
+
+    # Version of the file format, files with a different version are ignored
+    version = 2
+
+    def __init__(self, keys, costs, checksum=None):
+        self.keys = keys
+        self.costs = costs
+        self.checksum = checksum
+
+    @classmethod
+    def from_rows(cls, rows, checksum=None):
+        """Builds the map from (sku, alias, shipping_cost) rows."""
+        shipping_costs = {}
+
+        for sku, alias, shipping_cost in rows:
+            # The first cost that is set for a sku or alias is the one that is used
+            for key in (sku, alias):
+                if key and not shipping_costs.get(key):
+                    shipping_costs[key] = shipping_cost
+
+        keys = tuple(sorted(shipping_costs))
+        costs = tuple(
+            "" if shipping_costs[key] is None else str(shipping_costs[key])
+            for key in keys
+        )
+
+        return cls(keys, costs, checksum)
+
+    @classmethod
+    def load(cls, name="shipping_map"):
+        """Loads the map saved in CACHE_DIR, returns None when there is no usable file."""
+        path = os.path.join(CACHE_DIR, f"{name}.bin")
+
+        try:
+            with open(path, "rb") as file:
+                header = json.loads(file.readline())
+                if header.get("version") != cls.version:
+                    return None
+
+                keys = file.read(header["keys_size"]).decode("utf-8")
+                costs = file.read().decode("utf-8")
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not load the saved shipping map: {e}")
+            return None
+
+        keys = tuple(keys.split("\n")) if keys else ()
+        costs = tuple(costs.split("\n")) if keys else ()
+        if len(keys) != len(costs):
+            return None
+
+        return cls(keys, costs, header.get("checksum"))
+
+    def save(self, name="shipping_map"):
+        """Saves the map in CACHE_DIR, the file is replaced in one step so readers never see half of it."""
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        path = os.path.join(CACHE_DIR, f"{name}.bin")
+
+        keys = "\n".join(self.keys).encode("utf-8")
+        header = {
+            "version": self.version,
+            "checksum": self.checksum,
+            "keys_size": len(keys),
+        }
+
+        with open(f"{path}.tmp", "wb") as file:
+            file.write(json.dumps(header).encode("utf-8") + b"\n")
+            file.write(keys)
+            file.write("\n".join(self.costs).encode("utf-8"))
+
+        os.replace(f"{path}.tmp", path)
+
+    def _index(self, key):
+        if not isinstance(key, str):
+            return None
+
+        index = bisect_left(self.keys, key)
+        if index < len(self.keys) and self.keys[index] == key:
+            return index
+        return None
+
+    def get(self, key, default=None):
+        index = self._index(key)
+        if index is None:
+            return default
+
+        cost = self.costs[index]
+        return Decimal(cost) if cost else None
+
+    def __getitem__(self, key):
+        index = self._index(key)
+        if index is None:
+            raise KeyError(key)
+        return self.get(key)
+
+    def __contains__(self, key):
+        return self._index(key) is not None
+
+    def __len__(self):
+        return len(self.keys)
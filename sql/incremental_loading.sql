@@ -0,0 +1,35 @@
+-- Tables and indexes used when INCREMENTAL_LOADING is enabled in config.py
+
+-- Id of the last purchase order evaluated, the next run only scans the purchase orders after it.
+-- PurchaseOrders.id grows in insert order, unlike date_added, so a late purchase order with an older date is not missed.
+-- A watermark table created with the last_date_added column is updated with:
+--     ALTER TABLE SellerCloudUploadWatermark DROP COLUMN last_date_added;
+CREATE TABLE SellerCloudUploadWatermark (
+    name VARCHAR(50) NOT NULL PRIMARY KEY,
+    last_purchase_order_id INT NOT NULL,
+    updated_at DATETIME2 NOT NULL
+);
+
+-- Purchase orders behind the watermark that were skipped (missing skus or prices) or failed to upload
+CREATE TABLE SellerCloudUploadRetries (
+    purchase_order_id INT NOT NULL PRIMARY KEY,
+    reason VARCHAR(20) NOT NULL,
+    attempts INT NOT NULL,
+    last_attempt DATETIME2 NOT NULL
+);
+
+-- Pending purchase orders in watermark order, the filter keeps the index as small as the backlog.
+-- An index created on (date_added, id) is dropped and created again on id.
+CREATE NONCLUSTERED INDEX IX_PurchaseOrders_Pending
+ON PurchaseOrders (id)
+INCLUDE (dropshipper_id, state, country)
+WHERE in_sellercloud = 0 AND is_cancelled = 0;
+
+-- Items of a set of purchase orders
+CREATE NONCLUSTERED INDEX IX_PurchaseOrderItems_PurchaseOrderId
+ON PurchaseOrderItems (purchase_order_id)
+INCLUDE (sku, quantity);
+
+-- Write back of the uploaded orders, which are looked up by purchase_order_number
+CREATE NONCLUSTERED INDEX IX_PurchaseOrders_PurchaseOrderNumber
+ON PurchaseOrders (purchase_order_number);
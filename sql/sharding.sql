@@ -0,0 +1,16 @@
+-- Table used by the sharded mode (main.py --shards)
+
+-- Lease of every dropshipper's pending purchase orders, only the owner uploads them until expires_at
+-- released_at is set once the owner evaluated all of them, so the other workers of the same run skip the dropshipper
+CREATE TABLE SellerCloudUploadLeases (
+    sellercloud_customer_id INT NOT NULL PRIMARY KEY,
+    owner VARCHAR(200) NOT NULL,
+    expires_at DATETIME2 NOT NULL,
+    released_at DATETIME2 NULL
+);
+
+-- Pending purchase orders counted by dropshipper when the workers look for shards to lease
+CREATE NONCLUSTERED INDEX IX_PurchaseOrders_PendingByDropshipper
+ON PurchaseOrders (dropshipper_id)
+INCLUDE (state)
+WHERE in_sellercloud = 0 AND is_cancelled = 0;
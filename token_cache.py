@@ -0,0 +1,88 @@
+import json
+import os
+import time
+from config import CACHE_DIR, SELLERCLOUD_TOKEN_TTL, SELLERCLOUD_TOKEN_REFRESH_MARGIN
+
+
+class TokenCache:
+    """
+    Keeps the SellerCloud access token and the time it expires in a JSON file inside CACHE_DIR, so the next runs
+    and the other workers reuse it instead of getting their own.
+    The file can only be read by the user running the uploads, and the token is saved with the username it was
+    issued to, so a token of other credentials is never used.
+    With persist False nothing is read or written, every client gets its own token.
+    """
+
+    def __init__(
+        self,
+        username,
+        name="sellercloud_token",
+        ttl=SELLERCLOUD_TOKEN_TTL,
+        refresh_margin=SELLERCLOUD_TOKEN_REFRESH_MARGIN,
+        persist=True,
+    ):
+        self.username = username
+        self.persist = persist
+        self.path = os.path.join(CACHE_DIR, f"{name}.json")
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+
+    def is_fresh(self, expires_at):
+        """True if a token that expires at expires_at (a Unix time) can still be used."""
+        return time.time() < expires_at - self.refresh_margin
+
+    def load(self, rejected=None):
+        """Returns the token and its expiry from the file if it is still fresh and is not the rejected token, else None."""
+        if not self.persist:
+            return None
+
+        try:
+            with open(self.path) as file:
+                entry = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Error while reading the SellerCloud token cache: {e}")
+            return None
+
+        if (
+            entry.get("username") != self.username
+            or entry.get("token") == rejected
+            or not self.is_fresh(entry.get("expires_at", 0))
+        ):
+            return None
+
+        return entry["token"], entry["expires_at"]
+
+    def parse(self, token_response):
+        """Returns the token and its expiry from a GET_TOKEN response body."""
+        expires_in = token_response.get("expires_in") or self.ttl
+        return token_response["access_token"], time.time() + float(expires_in)
+
+    def save(self, token, expires_at):
+        if not self.persist:
+            return
+
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            temporary = f"{self.path}.{os.getpid()}.tmp"
+
+            # The file is created readable by its owner only, before the token is written to it
+            descriptor = os.open(
+                temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600
+            )
+            with os.fdopen(descriptor, "w") as file:
+                json.dump(
+                    {
+                        "username": self.username,
+                        "token": token,
+                        "expires_at": expires_at,
+                    },
+                    file,
+                )
+
+            # Replaced in one step, so another worker never reads half of it
+            os.replace(temporary, self.path)
+        except OSError as e:
+            # The token still works for this run, the next one gets its own
+            print(f"Error while saving the SellerCloud token cache: {e}")
@@ -0,0 +1,325 @@
+import atexit
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+import requests.exceptions
+from config import TRANSPORT_MODE, TRANSPORT_CASSETTE, TRANSPORT_LATENCY_SCALE
+
+# Query parameters and JSON fields that are never written to a cassette, so it can be shared without the credentials
+REDACTED_PARAMS = ("key",)
+REDACTED_FIELDS = ("access_token", "Password")
+
+# Transport settings of the run, main changes them with --record and --replay before the clients are created
+settings = {
+    "mode": TRANSPORT_MODE,
+    "cassette": TRANSPORT_CASSETTE,
+    "latency_scale": TRANSPORT_LATENCY_SCALE,
+}
+
+_cassettes = {}
+_cassettes_lock = threading.Lock()
+
+
+def configure(mode, cassette=TRANSPORT_CASSETTE, latency_scale=TRANSPORT_LATENCY_SCALE):
+    settings.update(mode=mode, cassette=cassette, latency_scale=latency_scale)
+
+
+def wrap(session, service):
+    """Returns the session the requests of service are sent through: session itself, or a transport that records
+    its traffic or replays it, following the transport settings. session is a requests.Session or the requests module.
+    """
+    mode = settings["mode"]
+
+    if not mode:
+        return session
+
+    cassette = _get_cassette(mode, settings["cassette"])
+
+    if mode == "record":
+        return RecordingTransport(session, cassette, service)
+
+    if mode == "replay":
+        return ReplayTransport(cassette, service, settings["latency_scale"])
+
+    raise ValueError(f"Invalid transport mode: {mode}")
+
+
+def _get_cassette(mode, path):
+    """Every client of the run shares the same cassette."""
+    with _cassettes_lock:
+        if (mode, path) not in _cassettes:
+            if mode == "record":
+                cassette = CassetteWriter(path)
+            else:
+                cassette = CassetteReader(path)
+
+            atexit.register(cassette.close)
+            _cassettes[(mode, path)] = cassette
+
+        return _cassettes[(mode, path)]
+
+
+class CassetteWriter:
+    """
+    Writes the recorded requests to a gzipped JSON lines file, one line per request as it completes.
+    A line has the service, method, url and a digest of the request body, and the status, headers, body and latency
+    of the response, or the error raised instead of it.
+    """
+
+    def __init__(self, path):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+        self.count = 0
+
+    def write(self, entry):
+        with self.lock:
+            if self.file:
+                self.file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+                self.count += 1
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+                print(f"Recorded {self.count} requests to {self.path}")
+
+
+class CassetteReader:
+    """
+    Serves the responses of a cassette in the order they were recorded.
+    A request gets the next response recorded for the same method, url and body. When the new build sends a request
+    that was not recorded, it gets the next response of the same endpoint (method and url path), and when those
+    run out the last one is served again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.exact = defaultdict(deque)
+        self.by_endpoint = defaultdict(deque)
+        self.last = {}
+        self.served = 0
+        self.unmatched = 0
+
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            for line in file:
+                entry = json.loads(line)
+                entry["used"] = False
+                self.exact[_exact_key(entry)].append(entry)
+                self.by_endpoint[_endpoint_key(entry)].append(entry)
+
+    def next_entry(self, request):
+        """Returns the recorded entry for the request, or None if its endpoint was never recorded."""
+        with self.lock:
+            self.served += 1
+            entry = _pop_unused(self.exact[_exact_key(request)])
+
+            if entry is None:
+                self.unmatched += 1
+                entry = _pop_unused(self.by_endpoint[_endpoint_key(request)])
+
+            endpoint = _endpoint_key(request)
+            if entry is None:
+                return self.last.get(endpoint)
+
+            entry["used"] = True
+            self.last[endpoint] = entry
+            return entry
+
+    def close(self):
+        print(
+            f"Replayed {self.served} requests from {self.path}, {self.unmatched} of them did not match a recorded request exactly"
+        )
+
+
+def _pop_unused(entries):
+    while entries:
+        entry = entries.popleft()
+        if not entry["used"]:
+            return entry
+
+    return None
+
+
+def _exact_key(entry):
+    # The host is left out, so a cassette can be replayed against another base url
+    url = urlsplit(entry["url"])
+    return entry["service"], entry["method"], url.path, url.query, entry["body"]
+
+
+def _endpoint_key(entry):
+    return entry["service"], entry["method"], urlsplit(entry["url"]).path
+
+
+class RecordingTransport:
+    """Sends the requests through the session and writes every request and its response to the cassette."""
+
+    def __init__(self, session, cassette, service):
+        self.session = session
+        self.cassette = cassette
+        self.service = service
+
+    def get(self, url, **kwargs):
+        return self.request("get", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("post", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("put", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("delete", url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        entry = _request_entry(self.service, method, url, kwargs.get("json"))
+        started = time.perf_counter()
+
+        try:
+            response = getattr(self.session, method)(url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            entry.update(
+                error=type(e).__name__,
+                latency=round(time.perf_counter() - started, 6),
+            )
+            self.cassette.write(entry)
+            raise
+
+        entry.update(
+            status=response.status_code,
+            headers={
+                name: response.headers[name]
+                for name in ("Content-Type", "Retry-After")
+                if name in response.headers
+            },
+            text=_redact_text(response.text),
+            latency=round(time.perf_counter() - started, 6),
+        )
+        self.cassette.write(entry)
+
+        return response
+
+    def close(self):
+        self.session.close()
+
+
+class ReplayTransport:
+    """Answers the requests with the responses of the cassette, after their recorded latency times latency_scale.
+    Nothing is sent over the network."""
+
+    def __init__(self, cassette, service, latency_scale=TRANSPORT_LATENCY_SCALE):
+        self.cassette = cassette
+        self.service = service
+        self.latency_scale = latency_scale
+
+    def get(self, url, **kwargs):
+        return self.request("get", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("post", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("put", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("delete", url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        entry = self.cassette.next_entry(
+            _request_entry(self.service, method, url, kwargs.get("json"))
+        )
+
+        if entry is None:
+            return ReplayedResponse(
+                404, f"{method.upper()} {url} is not in the cassette"
+            )
+
+        if self.latency_scale:
+            time.sleep(entry["latency"] * self.latency_scale)
+
+        if "error" in entry:
+            error = getattr(requests.exceptions, entry["error"], None)
+            if not isinstance(error, type) or not issubclass(
+                error, requests.exceptions.RequestException
+            ):
+                error = requests.exceptions.RequestException
+            raise error(f"Replayed {entry['error']}")
+
+        return ReplayedResponse(entry["status"], entry["text"], entry["headers"])
+
+    def close(self):
+        pass
+
+
+class ReplayedResponse:
+    """Response served from a cassette, with the parts of a requests response the clients use."""
+
+    def __init__(self, status_code, text, headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def _request_entry(service, method, url, body):
+    """The request part of a cassette line, without the credentials."""
+    if body is not None:
+        body = hashlib.sha256(
+            json.dumps(_redact(body), sort_keys=True, default=str).encode()
+        ).hexdigest()[:16]
+
+    return {
+        "service": service,
+        "method": method,
+        "url": _redact_url(url),
+        "body": body,
+    }
+
+
+def _redact_url(url):
+    parts = urlsplit(url)
+    if not parts.query:
+        return url
+
+    query = [
+        (name, "redacted" if name in REDACTED_PARAMS else value)
+        for name, value in parse_qsl(parts.query, keep_blank_values=True)
+    ]
+    return urlunsplit(parts._replace(query=urlencode(query, safe=",")))
+
+
+def _redact(value):
+    if isinstance(value, dict):
+        return {
+            key: "redacted" if key in REDACTED_FIELDS else _redact(item)
+            for key, item in value.items()
+        }
+
+    if isinstance(value, list):
+        return [_redact(item) for item in value]
+
+    return value
+
+
+def _redact_text(text):
+    """Redacts the fields of a JSON response body, other bodies are kept as they are."""
+    if not any(field in text for field in REDACTED_FIELDS):
+        return text
+
+    try:
+        return json.dumps(_redact(json.loads(text)))
+    except ValueError:
+        return text